@@ -12,8 +12,132 @@
 #     there will be an additional img_name column containing the filename
 #     of the image, to help identify later.
 #
+#   Passing x_datatype='SMALLINT[]' to any of the load functions (or
+#     -x SMALLINT[] on the command line) stores integer images, such as
+#     uint8, as SMALLINT[] instead of REAL[], which halves their size.
+#     x_datatype='BYTEA' stores the raw buffer of each image instead, in its
+#     own dtype (1 byte per pixel for uint8), with two additional columns:
+#     shape INT[] and dtype TEXT (a numpy dtype name such as 'uint8').
+#     Each image can be restored with np.frombuffer(x, dtype).reshape(shape).
+#
 #   ImageLoader.ROWS_PER_FILE = 1000 by default; this is the number of rows per
-#      temporary file (or StringIO buffer) loaded at once.
+#      COPY (and per temporary file, if those are used) loaded at once.
+#      Setting it to None sizes blocks adaptively instead:  a few images are
+#      serialized before loading to estimate their size, and each block gets
+#      as many rows as fit in ImageLoader.BYTES_PER_FILE (32 MB by default),
+#      but no more than needed to give each worker a few blocks.
+#
+#   Passing num_workers='auto' (or None) to ImageLoader picks the number of
+#      workers at the start of each load.  Up to one worker per CPU is
+#      started, and the first blocks are loaded with 1, 2, 4, ... of them
+#      busy at a time.  Once adding workers no longer improves throughput by
+#      at least ImageLoader.WARM_UP_MIN_GAIN (10% by default), because the
+#      database or the client has become the bottleneck, the workers that
+#      aren't needed are stopped and the rest of the load uses the others.
+#
+#   By default, the workers and their database connections only last for one
+#      call to a load function.  Passing persistent=True to ImageLoader (or
+#      using it as a context manager, "with ImageLoader(...) as iloader:")
+#      keeps them, along with the connection of the calling process, until
+#      iloader.close() is called (or the with block exits), which saves
+#      starting them again when a dataset is loaded in many calls.  Before
+#      reusing a connection that has been idle for more than
+#      ImageLoader.HEALTH_CHECK_IDLE seconds (default 30), a worker checks
+#      that it still works, and reconnects if it doesn't.  Workers kept
+#      this way can't see the arrays passed to load_dataset_from_np since
+#      they were forked, so each block of arrays in memory is sent to them
+#      with its task, the way load_dataset_from_stream does.  Arrays memory
+#      mapped from .npy files (by passing their paths, or arrays returned by
+#      np.load(path, mmap_mode='r')) are mapped by the workers themselves,
+#      and without persistent=True, the workers are forked for each call to
+#      load_dataset_from_np and inherit the arrays instead.
+#
+#   By default, each block of rows is streamed to the database as it is
+#      generated, without being written to a temporary file or held in a
+#      buffer.  Passing no_temp_files=False to any of the load functions (or
+#      --temp-files on the command line) writes each block to a temporary
+#      file under /tmp first, and loads it from there.
+#
+#   Passing resume=True to any of the load functions (or --resume on the
+#      command line) makes the load resumable.  Each block is then committed
+#      in the same transaction as a row recording it in a side table named
+#      <table_name>_load_manifest.  If the load is interrupted, calling the
+#      same function again with the same arguments and resume=True skips
+#      every block that was already committed, and appends the rest to the
+#      existing table.  This assumes the dataset (or the files under
+#      root_dir) hasn't changed in between.  Blocks are identified by their
+#      index, so the number of images per block is recorded in the manifest
+#      too, and a load that would use a different one (because of another
+#      ROWS_PER_FILE, or with ROWS_PER_FILE=None, another number of workers)
+#      refuses to resume.
+#      The manifest table is kept after the load completes, and can be dropped
+#      once it is no longer needed.
+#
+#   Passing incremental=True to load_dataset_from_disk (or -i on the command
+#      line) only loads the images under root_dir that are new or have
+#      changed since the last incremental load into the same table, so that
+#      appending a few new images to a large table only takes time
+#      proportional to the number of new images.  Each image loaded is
+#      recorded in a side table named <table_name>_load_index, with its
+#      label, img_name, size, mtime and SHA-1 hash, in the same transaction
+#      as its row.  Images whose size and mtime haven't changed are skipped
+#      without being read, and images with a new mtime are skipped if their
+#      hash is the same.  The rows of images that have changed are deleted
+#      and loaded again.  Images deleted from root_dir are left in the
+#      table.  After the load, any new image whose content is identical to
+#      an image under a different label is reported, and listed in
+#      iloader.duplicates.  Images loaded without incremental=True aren't in
+#      the index, so the first incremental load of a table should create
+#      it.  incremental=True can't be combined with resume=True,
+#      staging=True, gpfdist=True or copy_connections.
+#
+#   Passing staging=True to any of the load functions (or --staging on the
+#      command line) makes the load all-or-nothing.  The workers then COPY
+#      into an UNLOGGED table named <table_name>_load_staging, which skips
+#      the write-ahead log, and once every block is loaded its rows are moved
+#      into table_name with one INSERT ... SELECT, in the same transaction
+#      that drops the staging table.  If the load fails, table_name is left
+#      as it was, and the staging table is dropped by the next load into the
+#      same table (or, with resume=True, is kept and the load resumed).
+#      Unlogged tables require PostgreSQL 9.1+ or Greenplum 6+.
+#
+#   On Greenplum, passing gpfdist=True to any of the load functions loads the
+#      images through a readable external table instead of COPY.  The blocks
+#      serialized by the workers are served over HTTP by a small gpfdist
+#      compatible server running in this process, and every segment pulls
+#      blocks from it in parallel with a single INSERT ... SELECT, so the
+#      data doesn't all have to pass through the master.  The whole load is
+#      one transaction.  The segment hosts must be able to connect to
+#      ImageLoader.GPFDIST_HOST (default: this host's fully qualified name)
+#      on ImageLoader.GPFDIST_PORT (default: 0, any free port).  Only the
+#      text format is supported, and gpfdist=True can't be combined with
+#      resume=True, staging=True or copy_connections.
+#
+#   Passing copy_connections=N to load_dataset_from_np,
+#      load_dataset_from_stream or load_dataset_from_disk (or
+#      --copy-connections N on the command line) separates the CPU bound part
+#      of the load from COPY.  The workers then only decode and serialize
+#      blocks, and this process loads them through N connections of its
+#      own, each running one COPY at a time in its own thread.  This keeps
+#      many COPYs going without one worker process per connection, and lets
+#      num_workers be set by the number of CPUs and N by what the database
+#      can absorb.  Blocks are always streamed from memory in this mode.
+#
+#   While loading, each worker keeps track of how many images and bytes it
+#      has loaded, and how much time it has spent decoding images (summed
+#      over its decoding threads), serializing them and in COPY.  The parent
+#      prints a progress line with the totals and rates every
+#      ImageLoader.PROGRESS_INTERVAL seconds (default 10, None to disable).
+#      After each load, the totals and per-worker counters are available as
+#      iloader.stats, and are also appended as one line of JSON to the file
+#      ImageLoader.STATS_FILE if it is set.
+#
+#   By default, each block of rows is sent to the database using the text
+#      format of COPY.  Passing binary=True to load_dataset_from_np or
+#      load_dataset_from_disk (or -b on the command line) sends them using
+#      the binary format of COPY instead, which avoids converting every pixel
+#      to decimal text and back.  This requires PostgreSQL 9.0+ or
+#      Greenplum 6+.
 #
 
 # There are two ways of using this module.  One is to load it with:
@@ -29,18 +153,32 @@
 #  to load them from a dataset already in an existing numpy array (such
 #  as the datasets that come prepackaged with keras).
 #
-#   The module API is pretty simple, only involving two classes:
+#   The module API is pretty simple, only involving five classes:
 #     ImageLoader
 #     DbCredentials
+#     ImagePreprocessor (optional)
+#     TrainingPreprocessor (optional)
+#     DataSplit (optional)
 #
-#     two functions (in addition to the class constructors):
+#     five functions (in addition to the class constructors):
 #
 #   ImageLoader.load_dataset_from_np
+#   ImageLoader.load_dataset_from_stream
 #   ImageLoader.load_dataset_from_disk
+#   ImageLoader.load_dataset_from_archive
+#   ImageLoader.export_table_to_np
 #
-#     and one adjustable parameter (change if default is not working well):
+#     and three adjustable parameters (change if default is not working well):
 #
 #   ImageLoader.ROWS_PER_FILE=1000
+#   ImageLoader.BYTES_PER_FILE=32 * 2**20
+#   ImageLoader.FLOAT_PRECISION=9
+#
+#     BYTES_PER_FILE is only used when ROWS_PER_FILE is None (see above).
+#
+#     FLOAT_PRECISION is the number of significant digits written for each
+#       floating point pixel value when using the text COPY format.  Integer
+#       images (such as uint8) are always written exactly.
 #
 #
 #   Workflow
@@ -55,10 +193,16 @@
 #     2a. Perform parallel image loading from numpy arrays:
 #
 #           iloader.load_dataset_from_np(data_x, data_y, table_name,
-#                                        append=False, label_datatype='TEXT')
+#                                        append=False, label_datatype='TEXT',
+#                                        binary=False)
 #
 #       data_x contains image data in np.array format, and data_y is a 1D np.array
-#           of the image categories (labels).
+#           of the image categories (labels).  Either one can also be an
+#           np.memmap, or the path to a .npy file (which will be memory-mapped
+#           rather than read into memory).  The arrays are shared with the
+#           worker processes when they are forked, and each worker is only
+#           sent the (start, stop) range of rows it should load, so the
+#           images are never pickled or copied between processes.
 #
 #       Default database credentials are: localhost port 5432, madlib db, no
 #           password.  Calling the default constructor DbCredentials() will attempt
@@ -77,19 +221,79 @@
 #       label_datatype is used for defining the datatype for y(label) in the output
 #           table, where y is a numeric array. Default datatype for y is TEXT
 #
+#       binary=True loads the images using the binary COPY format.  Supported
+#           label datatypes are TEXT, VARCHAR, SMALLINT, INT, BIGINT, REAL and
+#           DOUBLE PRECISION.
+#
+#  or,
+#
+#     2b. Perform parallel image loading from a dataset too large for memory:
+#
+#           iloader.load_dataset_from_stream(source, table_name, append=False,
+#                                            label_datatype='TEXT',
+#                                            binary=False, x_key='x',
+#                                            y_key='y')
+#
+#       source can be the path to a .npz archive (images and labels are read
+#           from its x_key and y_key members), a (data_x, data_y) pair of .npy
+#           paths or np.memmap objects, or any iterable yielding
+#           (x_batch, y_batch) pairs of numpy arrays.  It is read and sent to
+#           the workers one block of ROWS_PER_FILE images at a time, with at
+#           most a couple of blocks per worker in flight, so memory use does
+#           not grow with the size of the dataset.
+#
+#       The other parameters are the same as for load_dataset_from_np.
+#
 #  or,
 #
-#     2b. Perform parallel image loading from disk:
+#     2c. Perform parallel image loading from disk:
 #
 #           load_dataset_from_disk(self, root_dir, table_name, num_labels='all',
-#               append=False, label_datatype='TEXT'):
+#               append=False, label_datatype='TEXT', binary=False):
 #
 #       Calling this function instead will look in root_dir on the local disk of
 #           wherever this is being run.  It will skip over any files in that
 #           directory, but will load images contained in each of its
 #           subdirectories.  The images should be organized by category/class,
 #           where the name of each subdirectory is the label for the images
-#           contained within it.
+#           contained within it.  All of the images should be of the same
+#           shape, unless a preprocess is passed which resizes them (see
+#           below).
+#
+#       The files found in all of the subdirectories are split into batches
+#           of ROWS_PER_FILE images, and each worker picks up the next batch
+#           as soon as it finishes the previous one, so all workers stay busy
+#           regardless of how many labels there are or how the images are
+#           distributed among them.
+#
+#       Only files with one of the ImageLoader.EXTENSIONS (set it to None to
+#           load every file) are loaded.  The subdirectories are listed
+#           SCAN_THREADS at a time, and loading starts as soon as the first
+#           of them has been listed, so a root_dir holding millions of files
+#           is never listed all at once before anything is loaded.  Listing
+#           uses scandir (os.scandir, or the scandir package on python 2)
+#           when it's available, which avoids a stat per file.  With
+#           nested_labels=True, every directory under root_dir containing
+#           images is a label, named by its path relative to root_dir (eg.
+#           'animals/cat').  With scan_cache set to the path of a file, the
+#           listings are kept there, and later loads only list the
+#           directories modified since.
+#
+#       Within each worker, loading a batch is pipelined:  DECODE_THREADS
+#           threads decode images, a serializer thread formats them
+#           PIPELINE_CHUNK at a time, and the COPY is streamed to the database
+#           as the chunks become ready (with at most PIPELINE_DEPTH of them
+#           waiting), so decoding overlaps with sending data to the database.
+#
+#       Images are decoded with PIL, or JPEG files with TurboJPEG when the
+#           PyTurboJPEG package (and libjpeg-turbo) is installed.  Set
+#           ImageLoader.DECODER to 'pil' or 'turbojpeg' to choose one
+#           explicitly (default: 'auto').  When a preprocess resizes the
+#           images, JPEGs are decoded directly at 1/2, 1/4 or 1/8 scale
+#           whenever that is still at least as large as the resized image,
+#           which is several times faster than decoding them at full size.
+#           Installing Pillow-SIMD in place of Pillow also speeds up decoding
+#           and resizing with PIL, without any change here.
 #
 #       The table_name and append parameters are the same as described
 #           above.  num_labels is an optional parameter which can be used to
@@ -101,14 +305,190 @@
 #       label_datatype is used for defining the datatype for y(label) in the output
 #           table, where y is a numeric array. Default datatype for y is TEXT
 #
+#       binary is the same as described above.
+#
+#  or,
+#
+#     2d. Perform parallel image loading from tar or zip archives, without
+#         extracting them:
+#
+#           load_dataset_from_archive(self, archives, table_name,
+#               append=False, label_datatype='TEXT', binary=False):
+#
+#       archives is the path of a .tar, .tar.gz, .tar.bz2 or .zip archive, a
+#           glob pattern matching several of them (such as the shards of a
+#           WebDataset, eg. 'imagenet-train-*.tar'), or a list of paths.
+#           The label of each image is the name of the directory containing
+#           it within the archive (so an archive of a root_dir as described
+#           in 2c can be loaded as is), or, for WebDataset style archives,
+#           the contents of the member with the same name up to the first
+#           '.' and a .cls extension (eg. 'n01440764_10026.cls' holds the
+#           label of 'n01440764_10026.jpg', and only the first image of
+#           such a sample is loaded).  Without a .cls member, every image
+#           is loaded as a sample of its own, whatever dots its name has.
+#           The img_name column holds the name of the member.
+#
+#       Tar archives can only be read from the start, so each is loaded by
+#           a single worker, with different workers loading different shards
+#           in parallel.  Zip archives are split into batches of
+#           ROWS_PER_FILE images like a directory, so even a single zip
+#           archive is loaded by all of the workers.
+#
+#       The other parameters are the same as for load_dataset_from_disk.
+#
+#     Any of the load functions can also be passed preprocess, an
+#       ImagePreprocessor describing transforms the workers apply to each
+#       image before loading it, in this order:
+#
+#           preprocess = ImagePreprocessor(size=None, crop=None, mode=None,
+#                                          scale=False, mean=None, std=None)
+#
+#       mode converts to 'RGB' or 'L' (grayscale), treating images with 2
+#           channels as grayscale with alpha (LA), size resizes to
+#           (height, width) (or, if a single number, so that the shorter side
+#           has that length), crop takes a (height, width) crop from the
+#           center, scale divides integer images by the largest value of
+#           their dtype (255 for uint8), and mean and std (one number, or one
+#           per channel) normalize the result as (x - mean) / std.  Images of
+#           different shapes in root_dir can be loaded together by setting
+#           size (and mode, if some are grayscale and some color).  When
+#           loading from numpy arrays, each block of images is transformed at
+#           once.
+#
+#     Any of the load functions can also be passed training_preprocessor, a
+#       TrainingPreprocessor, to pack the images into a table of mini-batch
+#       buffers while they are loaded, instead of running MADlib's
+#       training_preprocessor_dl() on the image table afterwards:
+#
+#           training_preprocessor = TrainingPreprocessor(output_table,
+#               buffer_size=None, normalizing_const=1.0, class_values=None,
+#               num_classes=None, shuffle=True)
+#
+#       output_table and output_table_summary have the same layout as those
+#           created by training_preprocessor_dl(), so output_table can be
+#           passed to madlib_keras_fit() as is:  independent_var holds
+#           buffer_size images divided by normalizing_const (REAL[]),
+#           dependent_var their labels one-hot encoded over class_values
+#           (SMALLINT[]), and buffer_id numbers the buffers.  The workers
+#           pack the buffers of each block of images as they serialize it,
+#           and load them in the same transaction as the block.  A buffer
+#           never spans two blocks, so the number of images per block is
+#           rounded down to a multiple of buffer_size (or up to buffer_size),
+#           and only the last block of the table (or, without shuffle, of
+#           each label directory) can end with a smaller buffer.  By
+#           default, buffer_size is as many images as fit in
+#           TrainingPreprocessor.MAX_BUFFER_BYTES (128 MB as float32, well
+#           within the 1 GB limit of a postgres field, even as text), but
+#           no more than a block.  Like
+#           training_preprocessor_dl(), which packs the rows in a random
+#           order, load_dataset_from_np and load_dataset_from_disk load the
+#           images in a random order with shuffle (as if passed
+#           split=DataSplit(shuffle=True), see below), so that the buffers
+#           mix the labels instead of each holding a single label directory
+#           or run of data_y.  The other load functions pack the images in
+#           the order they are read, so they should already be shuffled, as
+#           the shards of a WebDataset usually are.  class_values defaults
+#           to the distinct labels
+#           in data_y for load_dataset_from_np, and to the label directories
+#           of root_dir for load_dataset_from_disk;  it has to be given for
+#           the other load functions, and with nested_labels=True.
+#           training_preprocessor can't be combined with staging=True,
+#           gpfdist=True, copy_connections or incremental=True.
+#
+#     load_dataset_from_np and load_dataset_from_disk can also be passed
+#       split, a DataSplit, to split the images between several tables as
+#       they are loaded, and/or load them in a random order:
+#
+#           split = DataSplit(fractions=None, stratify=True, seed=0,
+#                             shuffle=False)
+#
+#       fractions is a dict or list of (name, fraction) pairs, such as
+#           [('train', 0.8), ('valid', 0.1), ('test', 0.1)];  the images of
+#           each are loaded into table_name_<name> (table_name_train, ...)
+#           in the same pass.  With stratify, the images of each label are
+#           split separately, so each table gets the same proportion of
+#           every label.  Without it, load_dataset_from_disk draws the table
+#           of each image at random, so the tables only get close to their
+#           fractions.  shuffle loads the images of each table in a random
+#           order instead of in the order of data_x (or label by label), so
+#           that consecutive rows, and so the buffers of a later
+#           training_preprocessor_dl(), mix the labels.  The split and the
+#           order only depend on seed and the images, so loading the same
+#           images again with the same DataSplit gives the same tables, and
+#           resume=True picks up where an interrupted load stopped.  split
+#           can't be combined with staging=True, gpfdist=True,
+#           copy_connections or incremental=True, and only a split without
+#           fractions, to shuffle with another seed, can be combined with
+#           training_preprocessor.
+#
+#     The table created by any of the load functions can be tuned with
+#       these class attributes of ImageLoader:
+#
+#           DISTRIBUTED_BY  Greenplum distribution key, such as 'id', or
+#                           'RANDOMLY' (default: the database's choice)
+#           STORAGE         storage parameters for CREATE TABLE ... WITH,
+#                           such as 'appendonly=true, orientation=column,
+#                           compresstype=zlib, compresslevel=1' for an
+#                           append-optimized, compressed columnar table
+#           INDEXES         columns to create indexes on.  They are created
+#                           after all of the images are loaded, which is
+#                           much faster than maintaining them during COPY
+#           ANALYZE         run ANALYZE on the table after the load, so the
+#                           planner has statistics for it right away
+#
+#       DISTRIBUTED_BY and STORAGE only apply when the load creates the
+#       table, not when appending to an existing one.
+#
+#     3. Read an image table back into numpy arrays:
+#
+#           data_x, data_y = iloader.export_table_to_np(table_name,
+#               x_path=None, binary=True, dtype=None)
+#
+#       The table is split into blocks of ROWS_PER_FILE rows by id, and the
+#           workers COPY the blocks out of the database in parallel (COPY
+#           ... TO STDOUT, in the binary format unless the datatype of y
+#           isn't supported by it) and decode them.  The images are
+#           returned in id order, as an array of shape (rows,) + image
+#           shape, and the labels as a 1D array (None if the table has no y
+#           column).  The workers decode the images directly into a .npy
+#           file which they all map, and the images are returned memory
+#           mapped from it.  With x_path set to the path of a .npy file,
+#           that file is kept, so that tables larger than memory can be
+#           exported.  Otherwise, it is a temporary file, removed once the
+#           export is done (the array stays mapped until it is freed).
+#           dtype is the numpy dtype of the images returned
+#           (default: float32 for REAL[], int16 for SMALLINT[], and the
+#           dtype they were loaded with for BYTEA).  All of the images must
+#           have the same shape.
+#
 #
 # If you want to load an image dataset from disk, but don't feel like writing
 #  any python code to call the API, you can just run this file directly, passing
 #  these parameters on the command line.
 #
-# usage: madlib_image_loader.py [-h] [-r ROOT_DIR] [-n NUM_LABELS] [-d DB_NAME]
-#                               [-a] [-w NUM_WORKERS] [-p PORT] [-U USERNAME]
-#                               [-t HOST] [-P PASSWORD]
+# usage: madlib_image_loader.py [-h] [-r ROOT_DIR] [--archives ARCHIVES]
+#                               [-n NUM_LABELS] [-d DB_NAME]
+#                               [-a] [-w NUM_WORKERS] [-R ROWS_PER_FILE]
+#                               [-p PORT] [-U USERNAME]
+#                               [-t HOST] [-P PASSWORD] [-m] [--temp-files]
+#                               [-b] [-x X_DATATYPE] [--resize RESIZE]
+#                               [--crop CROP] [--mode {RGB,L}] [--scale]
+#                               [--mean MEAN] [--std STD]
+#                               [--decoder {auto,pil,turbojpeg}] [-g]
+#                               [--distributed-by DISTRIBUTED_BY]
+#                               [--storage STORAGE] [--index INDEXES]
+#                               [--analyze] [--staging]
+#                               [--copy-connections COPY_CONNECTIONS] [-i]
+#                               [--resume] [--nested-labels]
+#                               [--scan-cache SCAN_CACHE]
+#                               [--training-table TRAINING_TABLE]
+#                               [--buffer-size BUFFER_SIZE]
+#                               [--normalizing-const NORMALIZING_CONST]
+#                               [--class-values CLASS_VALUES]
+#                               [--num-classes NUM_CLASSES]
+#                               [--split SPLIT] [--no-stratify]
+#                               [--seed SEED] [--shuffle]
+#                               [--export EXPORT]
 #                               table_name
 #
 # positional arguments:
@@ -118,6 +498,8 @@
 #   -h, --help            show this help message and exit
 #   -r ROOT_DIR, --root-dir ROOT_DIR
 #                         Root directory of image directories (default: .)
+#   --archives ARCHIVES   Load from tar or zip archives matching this glob
+#                         pattern instead of ROOT_DIR (default: None)
 #   -n NUM_LABELS, --num-labels NUM_LABELS
 #                         Number of image labels (categories) to load. (default:
 #                         all)
@@ -131,41 +513,630 @@
 #                         numeric arrays
 #                         Example: INT, REAL, BIGINT (default: TEXT)
 #   -w NUM_WORKERS, --num-workers NUM_WORKERS
-#                         Name of parallel workers. (default: 5)
+#                         Name of parallel workers, or auto to choose them
+#                         during a warm-up. (default: 5)
+#   -R ROWS_PER_FILE, --rows-per-file ROWS_PER_FILE
+#                         Number of images loaded per COPY, or auto for blocks
+#                         of about 33554432 bytes (default: 1000)
 #   -p PORT, --port PORT  database server port (default: 5432)
 #   -U USERNAME, --username USERNAME
 #                         database user name (default: None)
 #   -t HOST, --host HOST  database server host. (default: localhost)
 #   -P PASSWORD, --password PASSWORD
 #                         database user password (default: None)
-#   -m, --no-temp-files   no temporary files, construct all image tables in-
-#                         memory (default: False)
+#   -m, --no-temp-files   no temporary files, stream all image tables
+#                         directly to the database (default: True)
+#   --temp-files          write each block of images to a temporary file
+#                         before loading it (default: False)
+#   -b, --binary          use binary COPY format instead of text (default:
+#                         False)
+#   -x X_DATATYPE, --x-datatype X_DATATYPE
+#                         SQL datatype of image column: REAL[], SMALLINT[] or
+#                         BYTEA (default: REAL[])
+#   --resize RESIZE       resize images to HEIGHT,WIDTH, or so that the
+#                         shorter side is RESIZE (default: None)
+#   --crop CROP           crop HEIGHT,WIDTH (or CROP,CROP) from the center of
+#                         each image (default: None)
+#   --mode {RGB,L}        convert images to RGB or grayscale (default: None)
+#   --scale               scale pixel values to [0, 1] (default: False)
+#   --mean MEAN           comma separated mean to subtract from each channel
+#                         (default: None)
+#   --std STD             comma separated std to divide each channel by
+#                         (default: None)
+#   --decoder {auto,pil,turbojpeg}
+#                         image decoder (default: auto)
+#   -g, --gpfdist         Greenplum only: load through an external table
+#                         served to the segments by this process (default:
+#                         False)
+#   --distributed-by DISTRIBUTED_BY
+#                         Greenplum only: distribution key of the table, or
+#                         RANDOMLY (default: None)
+#   --storage STORAGE     storage parameters of the table, eg.
+#                         "appendonly=true, orientation=column,
+#                         compresstype=zlib" (default: None)
+#   --index INDEXES       column to index once the images are loaded (can be
+#                         repeated) (default: [])
+#   --analyze             run ANALYZE on the table once the images are loaded
+#                         (default: False)
+#   --staging             load into an unlogged staging table, and move the
+#                         images into the table in one transaction at the end
+#                         (default: False)
+#   --copy-connections COPY_CONNECTIONS
+#                         number of connections this process loads the blocks
+#                         serialized by the workers through, instead of each
+#                         worker loading its own (default: None)
+#   -i, --incremental     only load images that are new or have changed since
+#                         the last incremental load (default: False)
+#   --resume              make the load resumable, or resume it if it was
+#                         interrupted (default: False)
+#   --nested-labels       use every directory under ROOT_DIR containing images
+#                         as a label, named by its relative path (default:
+#                         False)
+#   --scan-cache SCAN_CACHE
+#                         file in which to keep directory listings, so that
+#                         later loads only list modified directories
+#                         (default: None)
+#   --training-table TRAINING_TABLE
+#                         also pack the images into this table of mini-batch
+#                         buffers, as training_preprocessor_dl would
+#                         (default: None)
+#   --buffer-size BUFFER_SIZE
+#                         number of images per buffer of TRAINING_TABLE, or
+#                         None for one buffer per block (default: None)
+#   --normalizing-const NORMALIZING_CONST
+#                         value the images in TRAINING_TABLE are divided by
+#                         (default: 1.0)
+#   --class-values CLASS_VALUES
+#                         comma separated labels one-hot encoded in
+#                         TRAINING_TABLE, or None for the label directories
+#                         (default: None)
+#   --num-classes NUM_CLASSES
+#                         length of the one-hot encoded labels in
+#                         TRAINING_TABLE, if more than the number of class
+#                         values (default: None)
+#   --split SPLIT         comma separated name=fraction pairs, such as
+#                         train=0.8,valid=0.1,test=0.1, to split the images
+#                         between table_name_train, table_name_valid, ...
+#                         (default: None)
+#   --no-stratify         split the images without regard to their labels
+#                         (default: True)
+#   --seed SEED           seed of the random split and shuffle (default: 0)
+#   --shuffle             load the images in a random order (default: False)
+#   --export EXPORT       instead of loading images, export table_name to
+#                         EXPORT_x.npy and EXPORT_y.npy (default: None)
 #
 
 import argparse
-from cStringIO import StringIO
-from multiprocessing import Pool, current_process
+import BaseHTTPServer
+import binascii
+from collections import deque
+import copy
+from functools import partial
+import glob
+import hashlib
+from itertools import chain, islice, izip
+from multiprocessing import Pool, cpu_count, current_process
+from multiprocessing.pool import ThreadPool
+import io
+import json
+import mmap
 import os
+import Queue
 import random
 import signal
+import socket
+import SocketServer
 from shutil import rmtree
 import string
+import struct
+import tarfile
+import threading
 import time
 import traceback
+import zipfile
 
 import psycopg2 as db
 import numpy as np
 from PIL import Image
 
+try:
+    from turbojpeg import (TurboJPEG, TJPF_RGB, TJPF_GRAY, TJCS_GRAY,
+                           TJCS_CMYK, TJCS_YCCK)
+except ImportError:
+    TurboJPEG = None
+
+# scandir tells files and directories apart without a stat per entry.  It is
+#  os.scandir on python 3.5+, and the scandir package on older pythons.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 class SignalException(Exception):
     pass
 
+# Binary COPY file layout: 11-byte signature, 32-bit flags field and 32-bit
+#  header extension length, followed by tuples and a 16-bit -1 trailer.
+PGCOPY_HEADER = 'PGCOPY\n\377\r\n\0' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+
+# Maps SQL datatypes to (element type oid, numpy dtype in network byte order)
+#  for the binary COPY format.  A dtype of None means the value is sent as
+#  utf-8 encoded text.
+BINARY_TYPES = {
+    'SMALLINT': (21, '>i2'), 'INT2': (21, '>i2'),
+    'INT': (23, '>i4'), 'INTEGER': (23, '>i4'), 'INT4': (23, '>i4'),
+    'BIGINT': (20, '>i8'), 'INT8': (20, '>i8'),
+    'REAL': (700, '>f4'), 'FLOAT4': (700, '>f4'),
+    'DOUBLE PRECISION': (701, '>f8'), 'FLOAT8': (701, '>f8'),
+    'FLOAT': (701, '>f8'),
+    'TEXT': (25, None),
+    'VARCHAR': (1043, None), 'CHARACTER VARYING': (1043, None),
+}
+
+def _binary_type(datatype):
+    """
+    Returns (is_array, oid, dtype) for a SQL datatype such as 'INT' or 'REAL[]'
+    """
+    datatype = ' '.join(datatype.upper().split())
+    is_array = datatype.endswith('[]')
+    if is_array:
+        datatype = datatype[:-2].strip()
+    if datatype not in BINARY_TYPES:
+        raise ValueError("Datatype {0} is not supported with binary=True. "
+                         "Supported datatypes are: {1}"\
+            .format(datatype, ', '.join(sorted(BINARY_TYPES.keys()))))
+    oid, dtype = BINARY_TYPES[datatype]
+    return is_array, oid, dtype
+
+def _encode_text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _binary_field(payload):
+    return struct.pack('!i', len(payload)) + payload
+
+def _binary_scalar(value, dtype):
+    if dtype is None:
+        return _binary_field(_encode_text(value))
+    return _binary_field(np.asarray(value).astype(dtype).tobytes())
+
+def _binary_array(a, oid, dtype):
+    """
+    Encodes a numpy array in the wire format used by array_recv():
+        ndim, has-nulls flag, element oid, (dim size, lower bound) per dim,
+        then a (length, value) pair for every element.
+    For numeric types, the elements are laid out with a single structured
+        numpy array so the whole tensor is converted in one pass.
+    """
+    a = np.asarray(a)
+    header = struct.pack('!iii', a.ndim, 0, oid) + \
+        ''.join([struct.pack('!ii', dim, 1) for dim in a.shape])
+    if dtype is None:
+        body = ''.join([_binary_field(_encode_text(v)) for v in a.flat])
+    else:
+        elems = np.empty(a.size, dtype=[('len', '>i4'), ('val', dtype)])
+        elems['len'] = np.dtype(dtype).itemsize
+        elems['val'] = a.ravel()
+        body = elems.tobytes()
+    return _binary_field(header + body)
+
+def _copy_tuples(data):
+    """
+    Yields the fields of each tuple of a binary COPY stream, as a list of
+        (offset, length) pairs into data, with a length of -1 for NULL.
+    """
+    if not data.startswith(PGCOPY_HEADER[:11]):
+        raise ValueError("Invalid binary COPY data")
+    extension, = struct.unpack_from('!i', data, 15)
+    pos = 19 + extension
+    while True:
+        num_fields, = struct.unpack_from('!h', data, pos)
+        pos += 2
+        if num_fields == -1:
+            return
+        fields = []
+        for _ in xrange(num_fields):
+            length, = struct.unpack_from('!i', data, pos)
+            pos += 4
+            fields.append((pos, length))
+            pos += max(length, 0)
+        yield fields
+
+def _decode_binary_array(data, pos, dtype):
+    """
+    Decodes an array in the wire format written by _binary_array, starting at
+        offset pos of data.  Numeric elements are read with a single
+        structured numpy array, like they are written.
+    """
+    ndim, has_nulls, _ = struct.unpack_from('!iii', data, pos)
+    if has_nulls:
+        raise ValueError("Cannot read arrays containing NULLs")
+    shape = struct.unpack_from('!' + 'ii' * ndim, data, pos + 12)[::2]
+    pos += 12 + 8 * ndim
+    if ndim == 0:
+        return np.array([], dtype=dtype or object)
+    size = int(np.prod(shape))
+    if dtype is None:
+        values = []
+        for _ in xrange(size):
+            length, = struct.unpack_from('!i', data, pos)
+            values.append(data[pos + 4:pos + 4 + length])
+            pos += 4 + length
+        return np.array(values, dtype=object).reshape(shape)
+    elems = np.frombuffer(data, [('len', '>i4'), ('val', dtype)], size, pos)
+    return elems['val'].reshape(shape)
+
+def _decode_binary_field(data, field, datatype):
+    pos, length = field
+    if length == -1:
+        return None
+    is_array, _, dtype = _binary_type(datatype)
+    if is_array:
+        return _decode_binary_array(data, pos, dtype)
+    if dtype is None:
+        return data[pos:pos + length]
+    return np.frombuffer(data, dtype, 1, pos)[0]
+
+# Backslash escapes used by the text COPY format
+COPY_TEXT_ESCAPES = (('\\b', '\b'), ('\\f', '\f'), ('\\n', '\n'),
+                     ('\\r', '\r'), ('\\t', '\t'), ('\\v', '\v'))
+
+def _unescape_copy_text(value):
+    if '\\' not in value:
+        return value
+    parts = value.split('\\\\')
+    for escape, char in COPY_TEXT_ESCAPES:
+        parts = [part.replace(escape, char) for part in parts]
+    return '\\'.join(parts)
+
+def _decode_text_field(value, datatype):
+    """
+    Decodes a field of the text COPY format.  Arrays are only supported for
+        numeric datatypes.
+    """
+    if value == '\\N':
+        return None
+    value = _unescape_copy_text(value)
+    if datatype.endswith('[]'):
+        return np.array(json.loads(value.replace('{', '[').replace('}', ']')))
+    return value
+
+def _native_dtype(datatype):
+    """
+    Returns the numpy dtype in native byte order of the scalar SQL datatype,
+        or None if it isn't numeric (or isn't supported).
+    """
+    try:
+        is_array, _, dtype = _binary_type(datatype)
+    except ValueError:
+        return None
+    if is_array or dtype is None:
+        return None
+    return np.dtype(dtype).newbyteorder('=')
+
+# Datatypes supported for the image column x.  With BYTEA, the raw buffer of
+#  each image is stored in little-endian byte order, along with its shape
+#  (INT[]) and numpy dtype name (TEXT, eg. 'uint8' or 'float32') in the shape
+#  and dtype columns, so that np.frombuffer(x, dtype).reshape(shape)
+#  restores the original array.
+X_DATATYPES = ('REAL[]', 'SMALLINT[]', 'BYTEA')
+
+def _raw_buffer(a):
+    return np.ascontiguousarray(a, a.dtype.newbyteorder('<')).tobytes()
+
+def _x_datatype(datatype):
+    datatype = ''.join(datatype.upper().split())
+    if datatype not in X_DATATYPES:
+        raise ValueError("Datatype {0} is not supported for images.  "
+                         "Supported datatypes are: {1}"\
+            .format(datatype, ', '.join(X_DATATYPES)))
+    return datatype
+
+def _check_smallint(a):
+    """
+    Raises ValueError unless every value in array a can be stored exactly as
+        a SMALLINT
+    """
+    if np.can_cast(a.dtype, np.int16):
+        return
+    if a.dtype.kind not in 'iu':
+        raise ValueError("Cannot store images of dtype {0} as SMALLINT[], "
+                         "only integer images are supported".format(a.dtype))
+    if a.size > 0 and (a.min() < -2**15 or a.max() >= 2**15):
+        raise ValueError("Cannot store images as SMALLINT[], values must be "
+                         "between {0} and {1}".format(-2**15, 2**15 - 1))
+
+def _array_literal_template(shape, fmt):
+    """
+    Builds a %-format string which renders a flattened array of the given
+        shape as a postgres array literal, eg. '{{%d,%d},{%d,%d}}' for (2, 2)
+    """
+    if len(shape) == 0:
+        return fmt
+    inner = _array_literal_template(shape[1:], fmt)
+    return '{' + ','.join([inner] * shape[0]) + '}'
+
+def _byte_literal_tables(shape):
+    """
+    Lookup tables for rendering arrays of values in 0..255 (eg. uint8 images)
+        as postgres array literals without formatting any numbers at runtime.
+        Returns (prefix, sep_class, lut) where sep_class[j] is the number of
+        dimensions that end after flattened element j, and lut[v, k] is the
+        string for value v followed by the separator for sep_class k.  A row
+        is then prefix + ''.join(lut[row, sep_class]).
+    """
+    ndim = len(shape)
+    pos = np.arange(1, int(np.prod(shape)) + 1)
+    sep_class = np.zeros(len(pos), dtype=np.intp)
+    stride = 1
+    for dim in reversed(shape):
+        stride *= dim
+        sep_class += (pos % stride == 0)
+
+    seps = [','] + ['}' * k + ',' + '{' * k for k in range(1, ndim)] + \
+        ['}' * ndim]
+    lut = np.empty((256, ndim + 1), dtype=object)
+    for v in range(256):
+        for k, sep in enumerate(seps):
+            lut[v, k] = str(v) + sep
+    return '{' * ndim, sep_class, lut
+
+def _iter_npz_member(path, key, rows):
+    """
+    Reads the array stored as key in the .npz archive at path, rows at a time,
+        without ever holding the whole array in memory.
+    """
+    with zipfile.ZipFile(path) as archive:
+        f = archive.open(key + '.npy')
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortran_order or dtype.hasobject:
+            raise ValueError("Cannot stream {0} from {1}, only C-ordered "
+                             "arrays of non-object type are supported"\
+                .format(key, path))
+
+        row_shape = shape[1:]
+        row_bytes = dtype.itemsize * int(np.prod(row_shape))
+        for start in range(0, shape[0], rows):
+            n = min(rows, shape[0] - start)
+            yield np.frombuffer(f.read(n * row_bytes), dtype=dtype)\
+                .reshape((n,) + row_shape)
+
+# Extensions of archive members loaded as images, and of WebDataset style
+#  members holding the label of the image with the same key
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.ppm', '.pgm',
+                    '.tif', '.tiff', '.webp')
+LABEL_EXTENSION = '.cls'
+
+def _is_zip(path):
+    return path.lower().endswith('.zip')
+
+def _iter_archive_members(path):
+    """
+    Yields (name, read) for each file in a tar (optionally compressed) or zip
+        archive, where read() returns its contents.  Tar archives are read as
+        a stream, in archive order, so read() must be called before moving on
+        to the next member.  Zip members are sorted by name, and can be read
+        at any time, from any thread.
+    """
+    if _is_zip(path):
+        # Not closed here, as members can still be read after iterating
+        archive = zipfile.ZipFile(path)
+        for name in sorted(archive.namelist()):
+            if not name.endswith('/'):
+                yield name, lambda name=name: archive.read(name)
+    else:
+        with tarfile.open(path, 'r|*') as archive:
+            for info in archive:
+                if info.isfile():
+                    f = archive.extractfile(info)
+                    yield info.name, f.read
+
+def _archive_samples(path):
+    """
+    Groups the members of an archive into samples, and yields
+        (name, label, read) for each image, where read() returns the image
+        file (only valid until the next sample, for tar archives).  Members
+        whose names are the same up to the first '.' of the file name (eg.
+        'a/1.jpg' and 'a/1.cls') belong to the same sample, as in WebDataset
+        shards, if there is a .cls member holding the label of the sample.
+        Only the first image of such a sample is loaded (with a warning, if
+        there are others).  Without a .cls member, every image is a sample
+        of its own (so 'a/1.2019.png' and 'a/1.2020.png' are both loaded),
+        labelled with the name of the directory containing it.
+    """
+    key, images, label = None, [], None
+    members = _iter_archive_members(path)
+    for name, read in chain(members, [(None, None)]):
+        if name is None or _sample_key(name) != key:
+            if label is not None and len(images) > 1:
+                print("Warning: sample {0} of {1} has {2} images, only "
+                      "loading {3}".format(key, path, len(images),
+                                           images[0][0]))
+                images = images[:1]
+            for image_name, image_read in images:
+                image_label = label
+                if image_label is None:
+                    image_label = os.path.basename(os.path.dirname(
+                        image_name))
+                if not image_label:
+                    raise ValueError("No label found for {0}, archive "
+                                     "members should be in a directory named "
+                                     "after their label, or have a {1} member "
+                                     "with the same key"\
+                        .format(image_name, LABEL_EXTENSION))
+                yield image_name, image_label, image_read
+            if name is None:
+                break
+            key, images, label = _sample_key(name), [], None
+
+        extension = os.path.splitext(name)[1].lower()
+        if extension == LABEL_EXTENSION:
+            label = read().strip()
+        elif extension in IMAGE_EXTENSIONS:
+            if not _is_zip(path):
+                # Tar members have to be read before moving on to the next
+                data = read()
+                read = lambda data=data: data
+            images.append((name, read))
+
+def _sample_key(name):
+    directory, filename = os.path.split(name)
+    return os.path.join(directory, filename.split('.', 1)[0])
+
+class _IterFile(object):
+    """
+    Read-only file-like object over an iterable of strings, so that COPY can
+        pull data from a generator as it sends it rather than from a file or
+        a buffer holding all of it.  Keeps count of the bytes read, and of
+        the time spent waiting for the iterable to produce them.
+    """
+    def __init__(self, chunks):
+        self._chunks = self._timed(chunks)
+        self._buf = ''
+        self._pos = 0
+        self.bytes = 0
+        self.wait = 0.0
+
+    def _timed(self, chunks):
+        chunks = iter(chunks)
+        while True:
+            start = time.time()
+            chunk = next(chunks, None)
+            self.wait += time.time() - start
+            if chunk is None:
+                return
+            self.bytes += len(chunk)
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buf[self._pos:] + ''.join(self._chunks)
+            self._buf, self._pos = '', 0
+            return data
+
+        parts, n = [], 0
+        while n < size:
+            if self._pos >= len(self._buf):
+                self._buf, self._pos = next(self._chunks, None), 0
+                if self._buf is None:
+                    self._buf = ''
+                    break
+            part = self._buf[self._pos:self._pos + size - n]
+            self._pos += len(part)
+            parts.append(part)
+            n += len(part)
+        return ''.join(parts)
+
+class _GpfdistHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves blocks of serialized rows to Greenplum segments, speaking the
+        gpfdist protocol.  Every segment requests the same URL, and each block
+        is sent to only one of them, whichever asks for it first.  With
+        X-GP-PROTO: 1, each block is framed by filename ('F'), offset ('O'),
+        line number ('L') and data ('D') headers, each a type byte followed
+        by a 32-bit length.  Otherwise the blocks are sent back to back.  The
+        end of the data is signalled by closing the connection.
+    """
+    def do_GET(self):
+        server = self.server
+        if self.path.lstrip('/') != server.name:
+            self.send_error(404)
+            return
+
+        proto = int(self.headers.get('X-GP-PROTO', '0'))
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Expires', '0')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-GPFDIST-VERSION', 'madlib_image_loader')
+        self.send_header('X-GP-PROTO', str(proto))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        if self.headers.get('X-GP-DONE'):
+            return
+
+        offset, line = 0, 1
+        for block in server.blocks():
+            if proto == 1:
+                self.wfile.write(
+                    'F' + struct.pack('!i', len(server.name)) + server.name +
+                    'O' + struct.pack('!iq', 8, offset) +
+                    'L' + struct.pack('!iq', 8, line) +
+                    'D' + struct.pack('!i', len(block)))
+            self.wfile.write(block)
+            offset += len(block)
+            line += block.count('\n')
+
+    def log_message(self, format, *args):
+        pass
+
+class _GpfdistServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, name, max_blocks):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _GpfdistHandler)
+        self.name = name
+        self.queue = Queue.Queue(maxsize=max_blocks)
+        self.done = threading.Event()
+
+    def blocks(self):
+        while True:
+            try:
+                yield self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                if self.done.is_set() and self.queue.empty():
+                    return
+
+    def put(self, block, abort):
+        while not abort.is_set():
+            try:
+                self.queue.put(block, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+def _iter_blocks(chunks, rows):
+    """
+    Regroups an iterable of (x_batch, y_batch) chunks of any size into blocks
+        of exactly rows images (except for the last one).  Labels of shape
+        (n, 1) are flattened, as in load_dataset_from_np.
+    """
+    xs, ys, n = [], [], 0
+    for x, y in chunks:
+        x, y = np.asarray(x), np.asarray(y)
+        if len(x) != len(y):
+            raise ValueError("Invalid chunk passed, number of labels in "
+                             "y_batch ({0}) does not match number of images "
+                             "in x_batch ({1})".format(len(y), len(x)))
+        if y.ndim == 2 and y.shape[1] == 1:
+            y = y[:, 0]
+        xs.append(x)
+        ys.append(y)
+        n += len(x)
+        while n >= rows:
+            x = xs[0] if len(xs) == 1 else np.concatenate(xs)
+            y = ys[0] if len(ys) == 1 else np.concatenate(ys)
+            yield x[:rows], y[:rows]
+            xs, ys, n = [x[rows:]], [y[rows:]], n - rows
+    if n > 0:
+        yield np.concatenate(xs), np.concatenate(ys)
+
 def _worker_sig_handler(signum, frame):
     if signum == signal.SIGINT:
         msg = "Received SIGINT in worker."
     elif signum == signal.SIGTERM:
         msg = "Received SIGTERM in worker."
-        _worker_cleanup(None)
+        _worker_cleanup()
     elif signum == signal.SIGSEGV:
         msg = "Received SIGSEGV in worker."
         traceback.print_stack(frame)
@@ -174,16 +1145,28 @@ def _worker_sig_handler(signum, frame):
 
     raise SignalException(msg)
 
-def _call_disk_worker(label):
+def _call_disk_worker(batch): # batch = (shape, manifest unit,
+                              #          list of (label, filename))
     global iloader
-    iloader.call_disk_worker(label)
+    iloader._reset_task_stats()
+    iloader.call_disk_worker(batch)
+    return iloader.task_stats
 
-def _call_np_worker(data): # data = list of (x, y) or (x, y, num_images) tuples
-    try:                   #        of length self.ROWS_PER_FILE
-        if iloader.no_temp_files:
-            iloader._just_load(data)
+def _call_archive_worker(task): # task = (shape, archive path, index of
+                                #  first block, list of (name, label) of
+                                #  the samples of a zip block (or None),
+                                #  rows per block, indices of blocks to skip)
+    global iloader
+    iloader._reset_task_stats()
+    iloader.call_archive_worker(task)
+    return iloader.task_stats
+
+def _call_np_worker(data, unit=None): # data = list of (x, y) or
+    try:                              #  (x, y, num_images) tuples of length
+        if iloader.no_temp_files:     #  self.ROWS_PER_FILE
+            iloader._just_load(data, unit)
         else:
-            iloader._write_tmp_file_and_load(data)
+            iloader._write_tmp_file_and_load(data, unit)
     except Exception as e:
         if iloader.tmp_dir:
             iloader.rm_temp_dir()
@@ -195,28 +1178,131 @@ def _call_np_worker(data): # data = list of (x, y) or (x, y, num_images) tuples
         print traceback.format_exc()
         raise e
 
-# dummy param needed so this can be called for
-# each worker from Pool.map()
-def _worker_cleanup(dummy):
+def _split_unit(table, *parts):
+    return 'split/' + '/'.join([str(part) for part in (table,) + parts])
+
+def _rows_unit(start, stop):
+    return 'rows/{0}-{1}'.format(start, stop)
+
+def _label_unit(label, index):
+    return 'label/{0}/{1}'.format(label, index)
+
+def _archive_unit(path, index):
+    return 'archive/{0}/{1}'.format(path, index)
+
+def _content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+def _call_np_range_worker(bounds): # bounds = (start, stop) row range of the
+    start, stop = bounds              #  dataset shared with the workers
+    iloader._reset_task_stats()
+    _call_np_worker(zip(iloader._preprocess(iloader.data_x[start:stop]),
+                        iloader.data_y[start:stop]),
+                    _rows_unit(start, stop))
+    return iloader.task_stats
+
+def _call_np_block_worker(block): # block = (start, x_block, y_block), where
+    start, x_block, y_block = block #  start is the row number of x_block[0]
+    iloader._reset_task_stats()
+    _call_np_worker(zip(iloader._preprocess(x_block), y_block),
+                    _rows_unit(start, start + len(x_block)))
+    return iloader.task_stats
+
+def _call_np_data_worker(task): # task = (unit, x_block, y_block), the
+    unit, x_block, y_block = task   #  rows themselves
+    iloader._reset_task_stats()
+    _call_np_worker(zip(iloader._preprocess(x_block), y_block), unit)
+    return iloader.task_stats
+
+def _call_np_rows_worker(task): # task = (unit, indices of the rows of the
+    unit, indices = task          #  dataset shared with the workers)
+    iloader._reset_task_stats()
+    _call_np_worker(zip(iloader._preprocess(iloader.data_x[indices]),
+                        iloader.data_y[indices]), unit)
+    return iloader.task_stats
+
+# Runs a task loading into one of the tables of a DataSplit
+def _call_split_worker(task): # task = (table, function, task of function)
+    table, func, task = task
+    iloader.target_table = table
+    try:
+        return func(task)
+    finally:
+        iloader.target_table = None
+
+# The _serialize_* functions are used instead of the _call_* functions above
+#  when gpfdist=True or copy_connections is set.  They return the serialized
+#  block, with the unit it is recorded as in the manifest, and its stats.
+
+def _serialize_np_range(bounds):
+    start, stop = bounds
+    iloader._reset_task_stats()
+    block = iloader._serialize(zip(
+        iloader._preprocess(iloader.data_x[start:stop]),
+        iloader.data_y[start:stop]))
+    iloader._add_task_stat('rows', stop - start)
+    return block, _rows_unit(start, stop), iloader.task_stats
+
+def _serialize_np_block(block):
+    start, x_block, y_block = block
+    iloader._reset_task_stats()
+    block = iloader._serialize(zip(iloader._preprocess(x_block), y_block))
+    iloader._add_task_stat('rows', len(x_block))
+    return block, _rows_unit(start, start + len(x_block)), iloader.task_stats
+
+def _serialize_disk_batch(batch):
+    iloader._reset_task_stats()
+    rows, files, unit = iloader._decode_batch(batch)
+    block = iloader._serialize(list(rows))
+    iloader._add_task_stat('rows', len(files))
+    return block, unit, iloader.task_stats
+
+def _call_export_worker(task): # task = (first row, number of rows, first id,
+    iloader._reset_task_stats()  #  first id of the next block, or None)
+    y_block = iloader.export_block(task)
+    return y_block, iloader.task_stats
+
+# Called when a worker is terminated.  The parent removes the directory
+#  containing every worker's temporary directory after that anyway.
+def _worker_cleanup():
     if iloader.tmp_dir:
         iloader.rm_temp_dir()
 
-def init_worker(mother_pid, table_name, append, no_temp_files, db_creds,
-                from_disk, root_dir=None):
+# Every task is run through _call_worker, along with the settings of the load
+#  it belongs to, since the same workers can be used for several loads
+def _call_worker(args): # args = (settings, function, task)
+    settings, func, task = args
+    iloader._configure(settings)
+    iloader.db_connect()
+    return func(task)
+
+def _memmap_spec(a):
+    """
+    Returns what is needed to map the same file as a, if a is a np.memmap of
+        a whole file (as returned by np.load(path, mmap_mode='r')), or None.
+    """
+    if isinstance(a, np.memmap) and isinstance(a.base, mmap.mmap) and \
+            a.filename:
+        order = 'F' if a.flags.f_contiguous and not a.flags.c_contiguous \
+            else 'C'
+        return a.filename, a.dtype, a.offset, a.shape, order
+    return None
+
+def _open_memmap(spec, mode='r'):
+    filename, dtype, offset, shape, order = spec
+    return np.memmap(filename, dtype, mode, offset, shape, order)
+
+def init_worker(mother_pid, db_creds, data_x=None, data_y=None):
     pr = current_process()
     print("Initializing {0} [pid {1}]".format(pr.name, pr.pid))
 
     try:
         iloader = ImageLoader(db_creds=db_creds)
         iloader.mother_pid = mother_pid
-        iloader.table_name = table_name
-        iloader.no_temp_files = no_temp_files
-        iloader.root_dir = root_dir
-        iloader.from_disk = from_disk
+        iloader.data_x = data_x
+        iloader.data_y = data_y
         signal.signal(signal.SIGINT, _worker_sig_handler)
         signal.signal(signal.SIGSEGV, _worker_sig_handler)
-        if not no_temp_files:
-            iloader.mk_temp_dir()
         iloader.db_connect()
     except Exception as e:
         if iloader.tmp_dir:
@@ -238,39 +1324,633 @@ class DbCredentials:
         self.host = host
         self.port = port
 
+class ImagePreprocessor:
+    """
+    Transforms applied to every image by the workers before it is loaded, in
+        this order:
+    @mode: Convert to 'RGB' or 'L' (grayscale).  Images can have 1 (L), 2
+        (LA), 3 (RGB) or 4 (RGBA) channels; alpha is dropped, as by PIL
+    @size: Resize to (height, width), or if a single number, resize so that
+        the shorter side has that length, keeping the aspect ratio
+    @crop: Crop (height, width), or (size, size) if a single number, from the
+        center of the image
+    @scale: Divide integer images by the largest value of their dtype (eg.
+        255 for uint8), so pixel values are in [0, 1]
+    @mean, std: Subtract mean, then divide by std.  Either can be a single
+        number, or one number per channel
+    Images keep their dtype, unless scale, mean or std is set, in which case
+        they are loaded as float32.  Images other than uint8 are resized as
+        float32, and cast back to their dtype (rounded, for integers).
+    """
+    # Weights used by PIL to convert RGB to grayscale
+    GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+    def __init__(self, size=None, crop=None, mode=None, scale=False,
+                 mean=None, std=None):
+        if mode not in (None, 'RGB', 'L'):
+            raise ValueError("Unsupported mode {0}, use 'RGB' or 'L'"\
+                .format(mode))
+        self.size = size
+        self.crop = (crop, crop) if isinstance(crop, int) else crop
+        self.mode = mode
+        self.scale = scale
+        self.mean = None if mean is None else np.float32(mean)
+        self.std = None if std is None else np.float32(std)
+
+    def _resize_to(self, height, width):
+        if not isinstance(self.size, int):
+            return tuple(self.size)
+        if height <= width:
+            return self.size, int(round(width * self.size / float(height)))
+        return int(round(height * self.size / float(width))), self.size
+
+    def _convert(self, x):
+        # x is a block of images, of shape (n, height, width[, channels])
+        channels = x.shape[3] if x.ndim == 4 else 1
+        if channels not in (1, 2, 3, 4):
+            raise ValueError("Cannot convert images with {0} channels to {1}, "
+                             "only 1 (L), 2 (LA), 3 (RGB) or 4 (RGBA) "
+                             "channels are supported".format(channels,
+                                                            self.mode))
+        if channels == 2:
+            x, channels = x[..., 0], 1
+        if self.mode == 'L' and channels > 1:
+            gray = x[..., :3].dot(np.float32(self.GRAY_WEIGHTS))
+            if x.dtype.kind in 'iu':
+                gray = gray.round().astype(x.dtype)
+            return gray
+        if self.mode == 'RGB' and channels != 3:
+            if channels == 1:
+                x = x.reshape(x.shape[:3] + (1,))
+                return np.repeat(x, 3, axis=3)
+            return x[..., :3]
+        return x
+
+    def _resize(self, a, height, width):
+        if a.dtype == np.uint8 and (a.ndim == 2 or a.shape[2] in (3, 4)):
+            image = Image.fromarray(a).resize((width, height), Image.BILINEAR)
+            return np.asarray(image)
+        # Other dtypes are resized one channel at a time, as 32-bit floats
+        planes = a.reshape(a.shape[:2] + (-1,)).astype(np.float32)
+        planes = [np.asarray(Image.fromarray(planes[:, :, c], 'F')
+                             .resize((width, height), Image.BILINEAR))
+                  for c in range(planes.shape[2])]
+        resized = np.stack(planes, axis=2).reshape((height, width) +
+                                                   a.shape[2:])
+        if a.dtype.kind in 'iu':
+            info = np.iinfo(a.dtype)
+            resized = np.clip(resized.round(), info.min, info.max)
+        return resized.astype(a.dtype)
+
+    def _finish(self, x):
+        if self.crop:
+            height, width = self.crop
+            if x.shape[1] < height or x.shape[2] < width:
+                raise ValueError("Cannot crop {0}x{1} from images of shape "
+                                 "{2}".format(height, width, x.shape[1:]))
+            top = (x.shape[1] - height) // 2
+            left = (x.shape[2] - width) // 2
+            x = x[:, top:top + height, left:left + width]
+
+        if self.scale or self.mean is not None or self.std is not None:
+            divisor = None
+            if self.scale and x.dtype.kind in 'iu':
+                divisor = np.float32(np.iinfo(x.dtype).max)
+            x = x.astype(np.float32)
+            if divisor is not None:
+                x /= divisor
+            if self.mean is not None:
+                x -= self.mean
+            if self.std is not None:
+                x /= self.std
+        return x
+
+    def array(self, x, resize_to=None):
+        """
+        Transforms a block of images, of shape (n, height, width[, channels]).
+            resize_to overrides the (height, width) computed from size, for
+            images which were already decoded at a reduced scale.
+        """
+        x = np.asarray(x)
+        if len(x) == 0:
+            return x
+        if self.mode:
+            x = self._convert(x)
+        if self.size:
+            height, width = resize_to or self._resize_to(*x.shape[1:3])
+            if (height, width) != x.shape[1:3]:
+                x = np.stack([self._resize(a, height, width) for a in x])
+        return self._finish(x)
+
+    def image(self, image, resize_to=None):
+        """
+        Transforms a PIL image, returning a numpy array
+        """
+        if self.mode and image.mode != self.mode:
+            image = image.convert(self.mode)
+        if self.size:
+            height, width = resize_to or \
+                self._resize_to(image.size[1], image.size[0])
+            if (width, height) != image.size:
+                image = image.resize((width, height), Image.BILINEAR)
+        x = np.asarray(image)
+        return self._finish(x.reshape((1,) + x.shape))[0]
+
+class DataSplit:
+    """
+    Splits the images of a load between several tables, and/or shuffles the
+        order they are loaded in.  The split is decided by seed alone, so
+        loading the same images again with the same DataSplit puts every
+        image in the same table, in the same order.
+    @fractions: Dict or list of (name, fraction) pairs, eg.
+        [('train', 0.8), ('valid', 0.1), ('test', 0.1)].  The images of each
+        split are loaded into table_name_<name>.  The fractions must add up
+        to 1.  Default is None, to load every image into table_name
+    @stratify: Split the images of each label separately, so that every
+        split has the same proportion of each label.  Default is True
+    @seed: Seed of the random split and shuffle.  Default is 0
+    @shuffle: Load the images of each table in a random order, rather than
+        in the order of data_x, or label by label.  Default is False
+    """
+    def __init__(self, fractions=None, stratify=True, seed=0, shuffle=False):
+        if isinstance(fractions, dict):
+            fractions = sorted(fractions.items())
+        self.fractions = list(fractions) if fractions else None
+        if self.fractions and \
+                abs(sum(f for _, f in self.fractions) - 1.0) > 1e-6:
+            raise ValueError("The fractions of a DataSplit must add up to 1, "
+                             "got {0}".format(self.fractions))
+        self.stratify = stratify
+        self.seed = seed
+        self.shuffle = shuffle
+
+    def tables(self, table_name):
+        if not self.fractions:
+            return [table_name]
+        return ['{0}_{1}'.format(table_name, name)
+                for name, _ in self.fractions]
+
+    def _rng(self, key):
+        # Seeded by key as well, so that the split of each label doesn't
+        #  depend on the order the labels are split in
+        return np.random.RandomState(int(_content_hash(
+            '{0}/{1}'.format(self.seed, key))[:8], 16))
+
+    def _bounds(self, n):
+        ends = [int(round(c * n)) for c in
+                np.cumsum([f for _, f in self.fractions])]
+        ends[-1] = n
+        return zip([0] + ends[:-1], ends)
+
+    def split_indices(self, data_y):
+        """
+        Returns the indices of the rows of data_y that go in each table
+        """
+        n = len(data_y)
+        if not self.fractions:
+            parts = [np.arange(n)]
+        elif self.stratify:
+            data_y = np.asarray(data_y)
+            if data_y.ndim > 1:
+                raise ValueError("A stratified DataSplit needs one label per "
+                                 "image in data_y")
+            parts = [[] for _ in self.fractions]
+            for label in np.unique(data_y):
+                rows = np.flatnonzero(data_y == label)
+                rows = rows[self._rng(label).permutation(len(rows))]
+                for part, (start, stop) in zip(parts, self._bounds(len(rows))):
+                    part.append(rows[start:stop])
+            parts = [np.concatenate(part) for part in parts]
+        else:
+            rows = self._rng('').permutation(n)
+            parts = [rows[start:stop] for start, stop in self._bounds(n)]
+
+        if self.shuffle:
+            return [part[self._rng(i).permutation(len(part))]
+                    for i, part in enumerate(parts)]
+        return [np.sort(part) for part in parts]
+
+    def split_files(self, label, filenames):
+        """
+        Returns the filenames of a label that go in each table.  Without
+            stratify, each image is drawn at random, as the number of images
+            of the other labels isn't known yet.
+        """
+        if not self.fractions:
+            return [filenames]
+        rng = self._rng(label)
+        if self.stratify:
+            order = rng.permutation(len(filenames))
+            return [sorted(filenames[i] for i in order[start:stop])
+                    for start, stop in self._bounds(len(filenames))]
+        ends = np.cumsum([f for _, f in self.fractions])
+        draws = np.minimum(np.searchsorted(ends, rng.rand(len(filenames)),
+                                           side='right'), len(ends) - 1)
+        return [[f for f, draw in zip(filenames, draws) if draw == i]
+                for i in range(len(self.fractions))]
+
+    def shuffled(self, items, key):
+        return [items[i] for i in self._rng(key).permutation(len(items))]
+
+class TrainingPreprocessor:
+    """
+    Packs images into mini-batch buffers while they are loaded, in the layout
+        of the tables created by MADlib's training_preprocessor_dl(), so that
+        they can be passed to madlib_keras_fit() without another pass over the
+        image table.  Each buffer is one row of output_table:
+
+            independent_var  REAL[]      the images of the buffer, divided
+                                         by normalizing_const
+            dependent_var    SMALLINT[]  their labels, one-hot encoded
+                                         over class_values
+            buffer_id        INTEGER     0, 1, 2, ...
+
+        and the parameters are recorded in output_table_summary.
+    @output_table: Name of the table of buffers
+    @buffer_size: Number of images per buffer.  A buffer never spans two
+        blocks, so blocks are made a multiple of buffer_size images.  Default
+        is None, for as many images as fit in MAX_BUFFER_BYTES, or one
+        block if that is less
+    @normalizing_const: Value every pixel is divided by.  Default is 1.0
+    @class_values: Sorted list of the labels.  Default is None, for the
+        distinct values of data_y (load_dataset_from_np), or the label
+        directories of root_dir (load_dataset_from_disk)
+    @num_classes: Length of the one-hot encoded labels, if more than the
+        number of class_values (which are then padded with NULLs).  Default
+        is None
+    @shuffle: Load the images in a random order, so that each buffer mixes
+        the labels, as with training_preprocessor_dl().  Only applies to
+        load_dataset_from_np and load_dataset_from_disk, when they aren't
+        passed a split.  Default is True
+    """
+    # Largest size of the images of a buffer with the default buffer_size, as
+    #  float32.  A REAL[] can take about 3 times that in text COPY format,
+    #  and a postgres field can't be larger than 1 GB.
+    MAX_BUFFER_BYTES = 128 * 2**20
+
+    def __init__(self, output_table, buffer_size=None, normalizing_const=1.0,
+                 class_values=None, num_classes=None, shuffle=True):
+        if normalizing_const <= 0:
+            raise ValueError("normalizing_const must be greater than 0")
+        if buffer_size is not None and buffer_size < 1:
+            raise ValueError("buffer_size must be at least 1")
+        self.output_table = output_table
+        self.buffer_size = buffer_size
+        self.normalizing_const = normalizing_const
+        self.class_values = class_values
+        self.num_classes = num_classes
+        self.shuffle = shuffle
+        self._class_index = None
+
+    def _padded_class_values(self):
+        values = list(self.class_values)
+        if self.num_classes is not None:
+            if self.num_classes < len(values):
+                raise ValueError("num_classes ({0}) is less than the number "
+                                 "of class values ({1})".format(
+                                     self.num_classes, len(values)))
+            values += [None] * (self.num_classes - len(values))
+        return values
+
+    def pack(self, x_block, y_block):
+        """
+        Returns (independent_var, dependent_var) for a buffer of images and
+            their labels
+        """
+        if self._class_index is None:
+            self._class_index = dict((value, i) for i, value
+                                     in enumerate(self.class_values))
+        x = np.asarray(x_block, dtype=np.float32) / \
+            np.float32(self.normalizing_const)
+        y = np.zeros((len(y_block), len(self._padded_class_values())),
+                     dtype=np.int16)
+        for i, label in enumerate(y_block):
+            if label not in self._class_index:
+                raise ValueError("Label {0} is not one of the class_values "
+                                 "{1}".format(label, self.class_values))
+            y[i, self._class_index[label]] = 1
+        return x, y
+
 class ImageLoader:
-    def __init__(self, db_creds=None, num_workers=None, table_name=None):
-        self.num_workers = num_workers
+    def __init__(self, db_creds=None, num_workers=None, table_name=None,
+                 persistent=False):
+        # num_workers='auto' (or None) starts one worker per CPU for each
+        #  load, and keeps as many as the warm-up shows are useful
+        #
+        # persistent=True keeps the workers and the database connections
+        #  (the workers' and this process's) open from one load to the next,
+        #  until close() is called.  Using an ImageLoader as a context manager
+        #  does the same, and closes it on exit.
+        self.persistent = persistent
+        self.auto_workers = num_workers in (None, 'auto')
+        self.num_workers = cpu_count() if self.auto_workers else num_workers
+        self.rows_per_file = self.ROWS_PER_FILE
         self.append = False
         self.img_num = 0
         self.db_creds = db_creds
         self.db_conn = None
         self.db_cur = None
         self.tmp_dir = None
+        self.tmp_root = None
         self.mother = False
         self.pr_name = current_process().name
         self.table_name = table_name
         self.root_dir = None
+        self.from_disk = False
         self.pool = None
         self.no_temp_files = False
+        self.binary = False
+        self.label_datatype = 'TEXT'
+        self.x_datatype = 'REAL[]'
+        self.preprocess = None
+        self._templates = {}
+        self.data_x = None
+        self.data_y = None
+        self._decode_pool = None
+        self._zip_archives = {}
+        self._turbojpeg = None
+        self.resume = False
+        self.staging = False
+        self.incremental = False
+        self._index_rows = None
+        self.duplicates = []
+        self.completed_units = set()
+        self.gpfdist = False
+        self.copy_connections = None
+        self._copiers = []
+        self.export = None
+        self._export_x = None
+        self.training = None
+        self.split = None
+        self.target_table = None
+        self._packing = []
+        self._packed_rows = []
+        self.stats = None
+        self.load_id = 0
+        self._shared_data = None
+        self._warmed_up = False
+        self._db_used = 0
+        self._reset_task_stats()
 
         global iloader  # Singleton per process
         iloader = self
 
-    def terminate_workers(self):
-        if iloader.pool:
-            iloader.pool.map(_worker_cleanup, [0] * self.num_workers)
+    def __enter__(self):
+        self.persistent = True
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Terminates the workers, and closes the database connection kept open
+            by persistent=True
+        """
+        if self.pool:
+            self.terminate_workers()
+        for copier in self._copiers:
+            copier.db_close()
+        self._copiers = []
+        self.db_close(force=True)
+
+    def _spawn_workers(self, data_x=None, data_y=None, num_workers=None):
+        if num_workers is None and self.auto_workers:
+            num_workers = cpu_count()
+        if num_workers:
+            self.num_workers = num_workers
+        self._spawn_args = (data_x, data_y)
+
+        print("Spawning {0} workers...".format(self.num_workers))
+        self.pool = Pool(processes=self.num_workers,
+                         initializer=init_worker,
+                         initargs=(current_process().pid,
+                                   self.db_creds,
+                                   data_x,
+                                   data_y))
+
+    def _respawn_workers(self, num_workers):
+        data_x, data_y = self._spawn_args
+        self.pool.terminate()
+        self._spawn_workers(data_x, data_y, num_workers)
+
+    def _start_workers(self, data_x=None, data_y=None):
+        """
+        Gets the workers ready for a new load, reusing those of the last load
+            if they were kept (see persistent).  Returns whether the workers
+            can read data_x and data_y themselves: when both arrays are memory
+            mapped from whole files (eg. by np.load(path, mmap_mode='r')) the
+            workers map the same files, and otherwise, unless the workers are
+            to be kept, they are forked with their own inherited copy.  Kept
+            workers have to be sent the blocks of arrays in memory instead.
+        """
+        self.load_id += 1
+        self._shared_data = None
+        inherit = False
+        if data_x is not None:
+            specs = (_memmap_spec(data_x), _memmap_spec(data_y))
+            if None not in specs:
+                self._shared_data = specs
+            elif not self.persistent:
+                inherit = True
+
+        if inherit and self.pool:
+            self.terminate_workers()
+        if not self.no_temp_files and not self.tmp_dir:
+            self.mk_temp_dir()
+        if not self.pool:
+            self._warmed_up = False
+            if inherit:
+                self._spawn_workers(data_x, data_y)
+            else:
+                self._spawn_workers()
+        return inherit or self._shared_data is not None
+
+    # Attributes of the current load which the workers need
+    WORKER_SETTINGS = ('table_name', 'append', 'no_temp_files', 'from_disk',
+                       'root_dir', 'binary', 'label_datatype', 'x_datatype',
+                       'preprocess', 'resume', 'staging', 'incremental',
+                       'export', 'training', 'DECODER')
+
+    def _worker_settings(self):
+        settings = dict((name, getattr(self, name))
+                        for name in self.WORKER_SETTINGS)
+        settings.update({'load_id': self.load_id,
+                         'data': self._shared_data,
+                         'tmp_root': self.tmp_dir})
+        return settings
+
+    def _configure(self, settings):
+        """
+        Applies the settings of the load a task belongs to, in a worker, if
+            they aren't the ones of its last task
+        """
+        if settings['load_id'] == self.load_id:
+            return
+        for name in self.WORKER_SETTINGS:
+            setattr(self, name, settings[name])
+        if settings['data']:
+            self.data_x, self.data_y = [_open_memmap(spec)
+                                        for spec in settings['data']]
+        self._export_x = None
+        if self.export and self.export['x_file']:
+            self._export_x = _open_memmap(self.export['x_file'], 'r+')
+        for archive in self._zip_archives.values():
+            archive.close()
+        self._zip_archives = {}
+        self.tmp_root = settings['tmp_root']
+        self.load_id = settings['load_id']
+
+    def _imap(self, func, tasks):
+        settings = self._worker_settings()
+        return self.pool.imap_unordered(
+            _call_worker, ((settings, func, task) for task in tasks))
+
+    STAT_COUNTERS = ('rows', 'bytes', 'decode_s', 'serialize_s', 'copy_s')
+
+    # Seconds between progress lines printed while loading (None to disable),
+    #  and optional file to which the stats of each load are appended as JSON
+    PROGRESS_INTERVAL = 10
+    STATS_FILE = None
+
+    def _reset_task_stats(self):
+        self.task_stats = dict.fromkeys(self.STAT_COUNTERS, 0)
+        self.task_stats['worker'] = self.pr_name
+        self._stats_lock = threading.Lock()
+
+    def _add_task_stat(self, counter, value):
+        with self._stats_lock:
+            self.task_stats[counter] += value
+
+    def _start_stats(self):
+        self.stats = {'table_name': self.table_name,
+                      'num_workers': self.num_workers,
+                      'rows_per_file': self.rows_per_file,
+                      'total': dict.fromkeys(self.STAT_COUNTERS, 0),
+                      'workers': {}}
+        self._stats_start = self._last_progress = time.time()
+
+    def _rates(self, counters, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        return {'elapsed_s': elapsed,
+                'rows_per_s': counters['rows'] / elapsed,
+                'mb_per_s': counters['bytes'] / elapsed / 2**20}
+
+    # Adds the stats returned by a worker task to the totals, and prints a
+    #  progress line if PROGRESS_INTERVAL has passed since the last one
+    def _record_stats(self, task_stats):
+        worker = self.stats['workers'].setdefault(
+            task_stats['worker'], dict.fromkeys(self.STAT_COUNTERS, 0))
+        for counter in self.STAT_COUNTERS:
+            worker[counter] += task_stats[counter]
+            self.stats['total'][counter] += task_stats[counter]
 
+        now = time.time()
+        if self.PROGRESS_INTERVAL is not None and \
+                now - self._last_progress >= self.PROGRESS_INTERVAL:
+            self._last_progress = now
+            total = self.stats['total']
+            rates = self._rates(total, now - self._stats_start)
+            print("Progress: {0} images, {1:.1f} MB in {2:.0f}s ({3:.1f} "
+                  "images/s, {4:.2f} MB/s); decode {5:.1f}s, serialize "
+                  "{6:.1f}s, copy {7:.1f}s".format(
+                      total['rows'], total['bytes'] / 2.0**20,
+                      rates['elapsed_s'], rates['rows_per_s'],
+                      rates['mb_per_s'], total['decode_s'],
+                      total['serialize_s'], total['copy_s']))
+
+    def _finish_stats(self):
+        elapsed = time.time() - self._stats_start
+        self.stats['total'].update(self._rates(self.stats['total'], elapsed))
+        for worker in self.stats['workers'].values():
+            worker.update(self._rates(worker, elapsed))
+
+        if self.STATS_FILE:
+            with open(self.STATS_FILE, 'a') as f:
+                f.write(json.dumps(self.stats) + '\n')
+
+    def _bounded_imap(self, func, tasks, in_flight=None):
+        """
+        Like pool.imap, but reads tasks lazily, keeping at most in_flight
+            (default: two per worker) submitted at any time, so that tasks
+            (and their results) never have to be held in memory all at once.
+        """
+        in_flight = in_flight or 2 * self.num_workers
+        settings = self._worker_settings()
+        pending = deque()
+        for task in tasks:
+            if len(pending) >= in_flight:
+                yield pending.popleft().get()
+            pending.append(self.pool.apply_async(_call_worker,
+                                                 ((settings, func, task),)))
+        while pending:
+            yield pending.popleft().get()
+
+    # Tasks loaded per busy worker in each step of the warm-up, and the least
+    #  improvement in throughput for which it keeps adding workers
+    WARM_UP_TASKS_PER_WORKER = 2
+    WARM_UP_MIN_GAIN = 0.1
+
+    def _warm_up(self, func, tasks):
+        """
+        Chooses the number of workers, when num_workers='auto'.  The first
+            tasks are loaded with 1, 2, 4, ... workers busy at a time, until
+            the throughput of a step is less than WARM_UP_MIN_GAIN better
+            than the step before it.  The workers beyond the best step are
+            then terminated.  Returns an iterator over the remaining tasks.
+            Workers kept from an earlier load have already been chosen.
+        """
+        tasks = iter(tasks)
+        if not self.auto_workers or self._warmed_up:
+            return tasks
+        self._warmed_up = True
+
+        max_workers = self.num_workers
+        busy, best, best_rate = 1, 1, 0.0
+        while True:
+            step = list(islice(tasks, busy * self.WARM_UP_TASKS_PER_WORKER))
+            if not step:
+                break
+            start = time.time()
+            rows = 0
+            for task_stats in self._bounded_imap(func, step, busy):
+                self._record_stats(task_stats)
+                rows += task_stats['rows']
+            rate = rows / max(time.time() - start, 1e-9)
+            print("Warm-up: {0:.1f} images/s with {1} workers"\
+                .format(rate, busy))
+            if rate < best_rate * (1 + self.WARM_UP_MIN_GAIN):
+                break
+            best, best_rate = busy, rate
+            if busy == max_workers:
+                break
+            busy = min(2 * busy, max_workers)
+
+        self.stats['num_workers'] = best
+        task = next(tasks, None)
+        if task is None:
+            return iter([])
+        if best < self.num_workers:
+            print("Warm-up: continuing with {0} workers".format(best))
+            self._respawn_workers(best)
+        return chain([task], tasks)
+
+    def terminate_workers(self):
+        # Pool.terminate() waits for the workers to exit, so their temporary
+        #  directories can be removed along with this one afterwards
         self.pool.terminate()
         self.pool = None
+        if self.tmp_dir:
+            self.rm_temp_dir()
         print("{} workers terminated.".format(self.num_workers))
 
     def _random_string(self):
         return ''.join([random.choice(string.ascii_letters + string.digits)\
             for n in xrange(10)])
 
-    def mk_temp_dir(self):
-        self.tmp_dir = '/tmp/madlib_{0}'.format(self._random_string())
+    def mk_temp_dir(self, parent='/tmp'):
+        self.tmp_dir = os.path.join(parent, 'madlib_{0}'.format(
+            self._random_string()))
         os.mkdir(self.tmp_dir)
         print("{0}: Created temporary directory {1}"\
             .format(self.pr_name, self.tmp_dir))
@@ -281,9 +1961,17 @@ class ImageLoader:
             .format(self.pr_name, self.tmp_dir))
         self.tmp_dir = None
 
+    # Seconds a connection can be idle before db_connect() makes sure it is
+    #  still alive, before reusing it
+    HEALTH_CHECK_IDLE = 30
+
     def db_connect(self):
         if self.db_cur:
-            return
+            if self._db_alive():
+                return
+            print("{0}: Lost connection to {1} db, reconnecting."\
+                .format(self.pr_name, self.db_creds.db_name))
+            self.db_close(force=True)
 
         db_name = self.db_creds.db_name
         user = self.db_creds.user
@@ -299,25 +1987,43 @@ class ImageLoader:
             self.db_conn.autocommit = True
 
         except db.DatabaseError as error:
-            self.db_close()
+            self.db_close(force=True)
             print(error)
             raise error
 
+        self._db_used = time.time()
         print("{0}: Connected to {1} db.".
             format(self.pr_name, self.db_creds.db_name))
 
+    def _db_alive(self):
+        if self.db_conn.closed:
+            return False
+        if time.time() - self._db_used < self.HEALTH_CHECK_IDLE:
+            return True
+        try:
+            self.db_cur.execute("SELECT 1")
+        except (db.DatabaseError, db.InterfaceError):
+            return False
+        self._db_used = time.time()
+        return True
+
     def db_exec(self, query, args=None, echo=True):
         if self.db_cur is not None:
             if echo:
                 print "Executing: {0}".format(query)
             self.db_cur.execute(query, args)
+            self._db_used = time.time()
             if echo:
                 print self.db_cur.statusmessage
         else:
             raise RuntimeError("{0}: db_cur is None in db_exec"\
                 .format(self.pr_name))
 
-    def db_close(self):
+    def db_close(self, force=False):
+        # With persistent=True, the connection is kept for the next
+        #  db_connect(), until close()
+        if self.persistent and not force:
+            return
         if self.db_cur is not None:
             self.db_cur.close()
             self.db_cur = None
@@ -325,91 +2031,586 @@ class ImageLoader:
             self.db_conn.close()
             self.db_conn = None
 
-    def _gen_lines(self, data):
-        def f(x):
-            x = str(x.tolist())
-            return x.replace('[','{').replace(']','}')
-
-        for i, row in enumerate(data):
-            if len(row) == 3:
-                x, y, image_name = row
-                if not self.from_disk and y.ndim > 1:
-                    y = f(y)
-                yield '{0}|{1}|{2}\n'.format(f(x), y, image_name)
-            elif len(row) == 2:
-                x, y = row
-                if not self.from_disk and y.ndim > 1:
-                    y = f(y)
-                yield '{0}|{1}\n'.format(f(x), y)
-            else:
-                raise RuntimeError("Cannot write invalid row to table:\n{0}"\
-                    .format(row))
-
-    def _write_file(self, file_object, data):
-        lines = self._gen_lines(data)
-        file_object.writelines(lines)
+    def _array_literals(self, arrays):
+        """
+        Formats a list of numpy arrays as postgres array literals.  When all
+            of the arrays have the same shape (the usual case, one block of
+            images), they are stacked and formatted as a single block:
+            integer images with values in 0..255 are rendered from a lookup
+            table of pre-formatted strings, anything else by one %-format
+            operation per row against a template cached per shape.
+        """
+        if len(arrays) == 0:
+            return []
+        try:
+            block = np.stack(arrays)
+        except ValueError:  # shapes differ, format each array by itself
+            return [self._array_literals([a])[0] for a in arrays]
 
-    # This is default value, can be overriden by user, by setting
-    #   iloader.ROWS_PER_FILE after ImageLoader is created.
-    ROWS_PER_FILE = 1000
+        shape = block.shape[1:]
+        rows = block.reshape(len(arrays), -1)
 
-    # Copies from open file-like object f into database
-    def _copy_into_db(self, f, data):
-        table_name = self.table_name
+        if block.dtype.kind in 'biu' and block.size > 0 and \
+                block.min() >= 0 and block.max() <= 255:
+            key = (shape, 'byte')
+            if key not in self._templates:
+                self._templates[key] = _byte_literal_tables(shape)
+            prefix, sep_class, lut = self._templates[key]
+            rows = rows.astype(np.uint8)
+            return [prefix + ''.join(lut[r, sep_class].tolist()) for r in rows]
 
-        if self.from_disk:
-            self.db_cur.copy_from(f, table_name, sep='|', columns=['x','y',
-                                                                   'img_name'])
+        if block.dtype.kind in 'biu':
+            fmt = '%d'
         else:
-            self.db_cur.copy_from(f, table_name, sep='|', columns=['x','y'])
+            fmt = '%.{0}g'.format(self.FLOAT_PRECISION)
 
-        print("{0}: Loaded {1} images into {2}".format(self.pr_name, len(data),
-                                                       self.table_name))
+        key = (shape, fmt)
+        if key not in self._templates:
+            self._templates[key] = _array_literal_template(shape, fmt)
+        template = self._templates[key]
 
-    # Use in-memory buffer as file-like object to load a block of data into db
-    #  (no temp files written)
-    def _just_load(self, data):
-        f = StringIO()
-        self._write_file(f, data)
-        self._copy_into_db(f, data)
-        f.close()
+        return [template % tuple(r) for r in rows.tolist()]
 
-    # Write out a temporary file and then load it into db as a table
-    def _write_tmp_file_and_load(self, data):
-        table_name = self.table_name
+    def _preprocess(self, x_block):
+        if self.preprocess is None:
+            return x_block
+        return self.preprocess.array(x_block)
 
-        if not self.tmp_dir:
-            print("{0}: Can't find temporary directory... exiting."\
-                .format(self.pr_name))
-            time.sleep(1) # allow some time for p.terminate() to be called
-            return
+    # Decoder used for images on disk: 'pil', 'turbojpeg' (for JPEG files,
+    #  needs the PyTurboJPEG package and libjpeg-turbo), or 'auto', which
+    #  uses turbojpeg for JPEG files if it is available and pil otherwise.
+    DECODER = 'auto'
+    DECODERS = ('auto', 'pil', 'turbojpeg')
 
-        filename = os.path.join(self.tmp_dir, '{0}{1:04}.tmp'.format(
-            table_name, self.img_num))
+    def _turbojpeg_decoder(self):
+        """
+        Returns this process's TurboJPEG decoder, or None if JPEG files should
+            be decoded with PIL
+        """
+        if self.DECODER == 'pil':
+            return None
+        if self._turbojpeg is None:
+            try:
+                if TurboJPEG is None:
+                    raise ImportError("No module named turbojpeg")
+                self._turbojpeg = TurboJPEG()
+            except Exception:
+                if self.DECODER == 'turbojpeg':
+                    raise
+                self._turbojpeg = False
+        return self._turbojpeg or None
 
-        self.img_num += 1
-        with file(filename, 'w') as f:
-            self._write_file(f, data)
+    def _decode_turbojpeg(self, jpeg, path, data=None):
+        """
+        Decodes and preprocesses a JPEG file with TurboJPEG.  Returns None for
+            CMYK images, which are left to PIL.
+        """
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        width, height, _, colorspace = jpeg.decode_header(data)
+        if colorspace in (TJCS_CMYK, TJCS_YCCK):
+            return None
 
-        print("{0}: Wrote {1} images to {2}".format(self.pr_name, len(data),
-            filename))
+        preprocess = self.preprocess
+        gray = colorspace == TJCS_GRAY or \
+            (preprocess is not None and preprocess.mode == 'L')
+        resize_to = scale = None
+        if preprocess is not None and preprocess.size:
+            resize_to = preprocess._resize_to(height, width)
+            # Smallest scaling factor which doesn't go below resize_to
+            for num, denom in sorted(jpeg.scaling_factors,
+                                     key=lambda f: f[0] / float(f[1])):
+                if -(-height * num // denom) >= resize_to[0] and \
+                        -(-width * num // denom) >= resize_to[1]:
+                    scale = (num, denom)
+                    break
 
-        with file(filename, 'r') as f:
-            self._copy_into_db(f, data)
+        x = jpeg.decode(data, pixel_format=TJPF_GRAY if gray else TJPF_RGB,
+                        scaling_factor=scale)
+        if gray:
+            x = x.reshape(x.shape[:2])
+        if preprocess is None:
+            return x
+        return preprocess.array(x.reshape((1,) + x.shape), resize_to)[0]
 
-    def _validate_input_and_create_table(self, data_x=[], data_y=[]):
-        if len(data_x) != len(data_y):
-            raise ValueError("Invalid dataset passed, number of labels in "
-                             "data_y ({0}) does not match number of images "
-                             "in data_x ({1})"\
-                .format(len(data_y), len(data_x)))
+    def _load_image(self, path, data=None):
+        """
+        Decodes the image file at path (or, if given, data read from an image
+            file named path), and preprocesses it.  When it will be
+            resized (or converted to grayscale), a JPEG is decoded directly at
+            the smallest scale (1/2, 1/4 or 1/8) that is still at least as
+            large as the size it will be resized to, using PIL's draft mode or
+            TurboJPEG's scaling factors, which skips most of the decoding work.
+        """
+        if path.lower().endswith(('.jpg', '.jpeg')):
+            jpeg = self._turbojpeg_decoder()
+            if jpeg is not None:
+                x = self._decode_turbojpeg(jpeg, path, data)
+                if x is not None:
+                    return x
 
-        self.db_connect()
+        image = Image.open(path if data is None else io.BytesIO(data))
+        preprocess = self.preprocess
+        if preprocess is None:
+            # asarray, as the array interface of the image is already a copy
+            return np.asarray(image)
 
-        if self.append:
+        resize_to = None
+        if preprocess.size:
+            resize_to = preprocess._resize_to(image.size[1], image.size[0])
+        if image.format == 'JPEG' and (resize_to or preprocess.mode == 'L'):
+            height, width = resize_to or (image.size[1], image.size[0])
+            image.draft(preprocess.mode or image.mode, (width, height))
+        return preprocess.image(image, resize_to)
+
+    def _x_literals(self, arrays):
+        """
+        Formats the image column of each row for the text COPY format, along
+            with the shape and dtype columns when x_datatype is BYTEA.
+        """
+        if self.x_datatype == 'BYTEA':
+            return ['\\\\x{0}|{{{1}}}|{2}'.format(
+                        binascii.hexlify(_raw_buffer(a)),
+                        ','.join([str(dim) for dim in a.shape]), a.dtype.name)
+                    for a in arrays]
+        if self.x_datatype == 'SMALLINT[]':
+            for a in arrays:
+                _check_smallint(a)
+        return self._array_literals(arrays)
+
+    def _x_binary(self, x):
+        """
+        Encodes the image column of a row for the binary COPY format, along
+            with the shape and dtype columns when x_datatype is BYTEA.
+        """
+        if self.x_datatype == 'BYTEA':
+            return [_binary_field(_raw_buffer(x)),
+                    _binary_array(np.array(x.shape), 23, '>i4'),
+                    _binary_field(x.dtype.name)]
+        if self.x_datatype == 'SMALLINT[]':
+            _check_smallint(x)
+            return [_binary_array(x, 21, '>i2')]
+        return [_binary_array(x, 700, '>f4')]
+
+    # Columns of the table loaded by COPY, in the order they are serialized
+    def _column_defs(self):
+        types = {'x': self.x_datatype, 'shape': 'INT[]', 'dtype': 'TEXT',
+                 'y': self.label_datatype, 'img_name': 'TEXT'}
+        return ', '.join(['{0} {1}'.format(column, types[column])
+                          for column in self._columns()])
+
+    def _columns(self):
+        columns = ['x']
+        if self.x_datatype == 'BYTEA':
+            columns += ['shape', 'dtype']
+        columns.append('y')
+        if self.from_disk:
+            columns.append('img_name')
+        return columns
+
+    def _gen_lines(self, data):
+        xs = self._x_literals([np.asarray(row[0]) for row in data])
+
+        for i, row in enumerate(data):
+            if len(row) == 3:
+                x, y, image_name = row
+                if not self.from_disk and y.ndim > 0:
+                    y = self._array_literals([y])[0]
+                yield '{0}|{1}|{2}\n'.format(xs[i], y, image_name)
+            elif len(row) == 2:
+                x, y = row
+                if not self.from_disk and y.ndim > 0:
+                    y = self._array_literals([y])[0]
+                yield '{0}|{1}\n'.format(xs[i], y)
+            else:
+                raise RuntimeError("Cannot write invalid row to table:\n{0}"\
+                    .format(row))
+
+    def _gen_binary(self, data):
+        is_array, y_oid, y_dtype = _binary_type(self.label_datatype)
+
+        for row in data:
+            if len(row) not in (2, 3):
+                raise RuntimeError("Cannot write invalid row to table:\n{0}"\
+                    .format(row))
+            fields = self._x_binary(np.asarray(row[0]))
+            if is_array:
+                fields.append(_binary_array(np.atleast_1d(row[1]), y_oid,
+                                            y_dtype))
+            else:
+                fields.append(_binary_scalar(row[1], y_dtype))
+            if len(row) == 3:
+                fields.append(_binary_field(_encode_text(row[2])))
+            yield struct.pack('!h', len(fields)) + ''.join(fields)
+
+    def _gen_rows(self, data, pack=True):
+        if self.training and pack:
+            self._pack(data)
+        if self.binary:
+            return self._gen_binary(data)
+        return self._gen_lines(data)
+
+    def _pack(self, data, flush=False):
+        """
+        Adds rows to the buffer being packed, and serializes every full buffer
+            as a row of the training table, or with flush, any partial one
+        """
+        self._packing.extend((row[0], row[1]) for row in data)
+        size = self.training.buffer_size
+        while self._packing and (len(self._packing) >= size or flush):
+            rows, self._packing = self._packing[:size], self._packing[size:]
+            x, y = self.training.pack([row[0] for row in rows],
+                                      [row[1] for row in rows])
+            if self.binary:
+                self._packed_rows.append(struct.pack('!h', 2) +
+                                         _binary_array(x, 700, '>f4') +
+                                         _binary_array(y, 21, '>i2'))
+            else:
+                self._packed_rows.append('{0}|{1}\n'.format(
+                    *self._array_literals([x, y])))
+
+    # Adds the header and trailer required around rows in binary COPY format
+    def _frame(self, rows):
+        if self.binary:
+            return chain([PGCOPY_HEADER], rows, [PGCOPY_TRAILER])
+        return rows
+
+    def _write_file(self, file_object, data):
+        file_object.writelines(self._frame(self._gen_rows(data)))
+
+    def _serialize(self, data):
+        start = time.time()
+        block = ''.join(self._gen_rows(data))
+        self._add_task_stat('serialize_s', time.time() - start)
+        self._add_task_stat('bytes', len(block))
+        return block
+
+    # This is default value, can be overriden by user, by setting
+    #   iloader.ROWS_PER_FILE after ImageLoader is created.  None means
+    #   blocks of about BYTES_PER_FILE, estimated from SAMPLE_ROWS images,
+    #   with at least BLOCKS_PER_WORKER blocks for each worker.
+    ROWS_PER_FILE = 1000
+    BYTES_PER_FILE = 32 * 2**20
+    SAMPLE_ROWS = 16
+    BLOCKS_PER_WORKER = 4
+
+    def _rows_per_file(self, sample, num_images=None):
+        """
+        Returns the number of rows per block to load, and records it as
+            self.rows_per_file.
+        @sample: A few rows, as passed to _gen_rows, used to estimate the
+            serialized size of each row when ROWS_PER_FILE is None
+        @num_images: Number of images to be loaded, if known
+        """
+        rows = self.ROWS_PER_FILE
+        if rows is None and sample:
+            row_bytes = len(''.join(self._gen_rows(sample, pack=False))) / \
+                len(sample)
+            rows = max(1, self.BYTES_PER_FILE // max(row_bytes, 1))
+            if num_images:
+                per_worker = -(-num_images // (self.BLOCKS_PER_WORKER *
+                                               self.num_workers))
+                rows = max(1, min(rows, per_worker))
+            print("Loading blocks of {0} images (about {1} bytes each)"\
+                .format(rows, rows * row_bytes))
+        rows = rows or 1
+        if self.training:
+            rows = self._size_buffers(rows, sample)
+        self.rows_per_file = rows
+        if self.resume:
+            self._check_resume_rows(rows)
+        return rows
+
+    def _size_buffers(self, rows, sample):
+        """
+        Sets the buffer_size of the TrainingPreprocessor of the load, if it is
+            None, to as many images as fit in its MAX_BUFFER_BYTES, but no
+            more than rows.  Returns rows rounded down to a multiple of
+            buffer_size (or up to buffer_size), so that only the last block
+            of a label or table ends with a smaller buffer.
+        """
+        size = self.training.buffer_size
+        if size is None:
+            image_bytes = 4 * np.asarray(sample[0][0]).size if sample else 1
+            size = max(1, min(rows, self.training.MAX_BUFFER_BYTES //
+                                    max(image_bytes, 1)))
+            self.training = copy.copy(self.training)
+            self.training.buffer_size = size
+        if rows % size:
+            rows = max(size, rows // size * size)
+            print("Loading blocks of {0} images, a multiple of buffer_size "
+                  "({1})".format(rows, size))
+        return rows
+
+    # Unit of the manifest row recording the number of images per block of a
+    #  resumable load, which the units of the other rows depend on
+    ROWS_PER_FILE_UNIT = 'rows_per_file'
+
+    def _check_resume_rows(self, rows):
+        """
+        Records rows, the number of images per block, in the manifest of a
+            resumable load, or if it is already recorded, makes sure it is
+            the same, as blocks are only identified by their index.
+        """
+        self.db_connect()
+        try:
+            self.db_exec("SELECT num_rows FROM {0} WHERE unit = %s"
+                         .format(self._manifest_table()),
+                         (self.ROWS_PER_FILE_UNIT,), echo=False)
+            recorded = self.db_cur.fetchall()
+            if not recorded:
+                self.db_exec("INSERT INTO {0} (unit, num_rows) VALUES (%s, %s)"
+                             .format(self._manifest_table()),
+                             (self.ROWS_PER_FILE_UNIT, rows), echo=False)
+            elif recorded[0][0] != rows:
+                # The workers may have been started to size the blocks
+                if self.pool:
+                    self.terminate_workers()
+                raise ValueError("Cannot resume the load into {0}, which was "
+                                 "started with blocks of {1} images, with "
+                                 "blocks of {2} images.  Resume it with the "
+                                 "ROWS_PER_FILE (-R) it was started with, or "
+                                 "set ROWS_PER_FILE to {1}."
+                    .format(self.table_name, recorded[0][0], rows))
+        finally:
+            self.db_close()
+
+    # Significant digits used for floating point values in text COPY format.
+    #  9 is enough to round trip any float4 (REAL) value exactly.
+    FLOAT_PRECISION = 9
+
+    # Pipeline used by each worker when loading from disk: number of image
+    #  decoding threads, number of decoded images serialized together, and
+    #  number of serialized chunks which can be waiting to be sent by COPY.
+    DECODE_THREADS = 4
+    PIPELINE_CHUNK = 32
+    PIPELINE_DEPTH = 8
+
+    def _manifest_table(self):
+        return '{0}_load_manifest'.format(self.table_name)
+
+    def _staging_table(self):
+        return '{0}_load_staging'.format(self.table_name)
+
+    def _index_table(self):
+        return '{0}_load_index'.format(self.table_name)
+
+    # Copies from open file-like object f into database.  For resumable loads,
+    #  unit identifies the block being copied, and is recorded in the manifest
+    #  table in the same transaction.  For incremental loads, the images of
+    #  the block are recorded in the index table the same way.
+    def _copy_into_db(self, f, num_rows, unit=None):
+        start = time.time()
+        if (self.resume and unit is not None) or \
+                self._index_rows is not None or self.training:
+            self.db_exec("BEGIN", echo=False)
+            try:
+                self._copy(f)
+                # The buffers of the block go in the same transaction
+                if self.training:
+                    self._pack([], flush=True)
+                    self._copy(_IterFile(self._frame(self._packed_rows)),
+                               self.training.output_table,
+                               ['independent_var', 'dependent_var'])
+                if self.resume and unit is not None:
+                    self.db_exec("INSERT INTO {0} (unit, num_rows) "
+                                 "VALUES (%s, %s)"
+                                 .format(self._manifest_table()),
+                                 (unit, num_rows), echo=False)
+                # Only complete once f has been read, as the images are
+                #  hashed while they are decoded
+                if self._index_rows:
+                    self.db_exec("INSERT INTO {0} (label, img_name, size, "
+                                 "mtime, hash) VALUES {1}"
+                                 .format(self._index_table(),
+                                         ', '.join(['(%s, %s, %s, %s, %s)'] *
+                                                   len(self._index_rows))),
+                                 [v for row in self._index_rows for v in row],
+                                 echo=False)
+                self.db_exec("COMMIT", echo=False)
+            except Exception:
+                self.db_exec("ROLLBACK", echo=False)
+                raise
+            finally:
+                self._packing, self._packed_rows = [], []
+        else:
+            self._copy(f)
+        self._db_used = time.time()
+
+        # Time COPY spent waiting for a streamed block to be generated is
+        #  counted by whoever generated it, not as COPY time
+        self._add_task_stat('copy_s',
+                            time.time() - start - getattr(f, 'wait', 0))
+        self._add_task_stat('rows', num_rows)
+
+        print("{0}: Loaded {1} images into {2}".format(
+            self.pr_name, num_rows, self.target_table or self.table_name))
+
+    def _copy(self, f, table_name=None, columns=None):
+        if table_name is None:
+            table_name = self._staging_table() if self.staging \
+                else self.target_table or self.table_name
+        columns = columns or self._columns()
+
+        if self.binary:
+            sql = "COPY {0} ({1}) FROM STDIN WITH (FORMAT binary)"\
+                .format(table_name, ', '.join(columns))
+            self.db_cur.copy_expert(sql, f)
+        else:
+            self.db_cur.copy_from(f, table_name, sep='|', columns=columns)
+
+    # Stream a block of data into db, generating it as COPY reads it
+    #  (no temp files written, and the block is never fully buffered)
+    def _just_load(self, data, unit=None):
+        f = _IterFile(self._frame(self._gen_rows(data)))
+        self._copy_into_db(f, len(data), unit)
+        self._add_task_stat('serialize_s', f.wait)
+        self._add_task_stat('bytes', f.bytes)
+
+    # Write out a temporary file and then load it into db as a table
+    def _write_tmp_file_and_load(self, data, unit=None):
+        table_name = self.table_name
+
+        if not self.tmp_dir:
+            self.mk_temp_dir(self.tmp_root or '/tmp')
+
+        filename = os.path.join(self.tmp_dir, '{0}{1:04}.tmp'.format(
+            table_name, self.img_num))
+
+        self.img_num += 1
+        start = time.time()
+        with file(filename, 'wb') as f:
+            self._write_file(f, data)
+        self._add_task_stat('serialize_s', time.time() - start)
+        self._add_task_stat('bytes', os.path.getsize(filename))
+
+        print("{0}: Wrote {1} images to {2}".format(self.pr_name, len(data),
+            filename))
+
+        with file(filename, 'rb') as f:
+            self._copy_into_db(f, len(data), unit)
+        os.remove(filename)
+
+    def _validate_input_and_create_table(self, data_x=[], data_y=[]):
+        if len(data_x) != len(data_y):
+            raise ValueError("Invalid dataset passed, number of labels in "
+                             "data_y ({0}) does not match number of images "
+                             "in data_x ({1})"\
+                .format(len(data_y), len(data_x)))
+
+        self.x_datatype = _x_datatype(self.x_datatype)
+        if self.DECODER not in self.DECODERS:
+            raise ValueError("Unknown decoder {0}, use one of: {1}"\
+                .format(self.DECODER, ', '.join(self.DECODERS)))
+        if self.DECODER == 'turbojpeg' and TurboJPEG is None:
+            raise ValueError("DECODER is turbojpeg, but the PyTurboJPEG "
+                             "package is not installed")
+        if self.x_datatype == 'SMALLINT[]' and len(data_x) > 0:
+            _check_smallint(self._preprocess(np.asarray(data_x[:1])))
+
+        if self.binary:
+            _binary_type(self.label_datatype)
+
+        if self.incremental and (self.resume or self.staging or
+                                 self.gpfdist or self.copy_connections):
+            raise ValueError("incremental=True can't be combined with "
+                             "resume=True, staging=True, gpfdist=True or "
+                             "copy_connections")
+
+        if self.gpfdist and (self.binary or self.resume or self.staging or
+                             self.copy_connections):
+            raise ValueError("gpfdist=True can't be combined with "
+                             "binary=True, resume=True, staging=True or "
+                             "copy_connections")
+
+        if self.training and (self.staging or self.gpfdist or
+                              self.copy_connections or self.incremental):
+            raise ValueError("training_preprocessor can't be combined with "
+                             "staging=True, gpfdist=True, copy_connections "
+                             "or incremental=True")
+
+        if self.split and (self.staging or self.gpfdist or
+                           self.copy_connections or self.incremental):
+            raise ValueError("split can't be combined with staging=True, "
+                             "gpfdist=True, copy_connections or "
+                             "incremental=True")
+
+        if self.split and self.split.fractions and self.training:
+            raise ValueError("training_preprocessor can only be combined "
+                             "with a split without fractions")
+
+        self.db_connect()
+
+        self.completed_units = set()
+        manifest_exists = False
+        if self.resume:
+            try:
+                self.db_exec("SELECT unit FROM {0}"
+                             .format(self._manifest_table()), echo=False)
+                self.completed_units = set(r[0] for r in
+                                           self.db_cur.fetchall())
+                self.completed_units.discard(self.ROWS_PER_FILE_UNIT)
+                manifest_exists = True
+                self.append = True
+                print "Resuming load into table {0}, {1} blocks already "\
+                    "loaded".format(self.table_name, len(self.completed_units))
+            except db.DatabaseError:
+                pass
+
+        for table_name in self._target_tables():
+            self._create_table(table_name)
+
+        if self.resume and not manifest_exists:
+            self.db_exec("CREATE TABLE {0} (unit TEXT, num_rows INT)"
+                         .format(self._manifest_table()))
+
+        # buffer_id is filled in from a sequence, as buffers are COPYed by
+        #  all of the workers at once
+        if self.training and not self.append:
+            table = self.training.output_table
+            distribution = ' DISTRIBUTED BY (buffer_id)' \
+                if self.DISTRIBUTED_BY else ''
+            self.db_exec("CREATE TABLE {0} (independent_var REAL[], "
+                         "dependent_var SMALLINT[], buffer_id INTEGER){1}"
+                         .format(table, distribution))
+            self.db_exec("CREATE SEQUENCE {0}_buffer_id_seq MINVALUE 0 "
+                         "START 0 OWNED BY {0}.buffer_id".format(table))
+            self.db_exec("ALTER TABLE {0} ALTER COLUMN buffer_id SET DEFAULT "
+                         "nextval('{0}_buffer_id_seq')".format(table))
+
+        # The index of a table the load has just created can only be left
+        #  over from an earlier table of the same name
+        if self.incremental:
+            if not self.append:
+                self.db_exec("DROP TABLE IF EXISTS {0}"
+                             .format(self._index_table()), echo=False)
+            self.db_exec("CREATE TABLE IF NOT EXISTS {0} (label TEXT, "
+                         "img_name TEXT, size BIGINT, mtime DOUBLE PRECISION, "
+                         "hash TEXT, loaded_at TIMESTAMP DEFAULT now())"
+                         .format(self._index_table()))
+
+        # A staging table left over by an earlier load that failed is only
+        #  kept if the manifest says which of its rows are already there
+        if self.staging:
+            if not manifest_exists:
+                self.db_exec("DROP TABLE IF EXISTS {0}"
+                             .format(self._staging_table()), echo=False)
+            self.db_exec("CREATE UNLOGGED TABLE IF NOT EXISTS {0} ({1})"
+                         .format(self._staging_table(), self._column_defs()))
+
+        self.db_close()
+
+    def _target_tables(self):
+        if self.split:
+            return self.split.tables(self.table_name)
+        return [self.table_name]
+
+    def _create_table(self, table_name):
+        if self.append:
             # Validate that table already exists
             try:
-                self.db_exec("SELECT count(*) FROM {0}".format(self.table_name),
+                self.db_exec("SELECT count(*) FROM {0}".format(table_name),
                              echo=False)
             except db.DatabaseError:
                 raise RuntimeError("append=True passed, but cannot append to "
@@ -417,35 +2618,317 @@ class ImageLoader:
                                    "table exists and you have access to it, or "
                                    "use append=False (default) to auto-create it"
                                    "during loading."
-                    .format(self.table_name, self.db_creds.db_name))
+                    .format(table_name, self.db_creds.db_name))
 
-            print "Appending to table {0} in {1} db".format(self.table_name,
+            print "Appending to table {0} in {1} db".format(table_name,
                                                             self.db_creds.db_name)
         else:
-            y_type = self.label_datatype
             # Create new table
             try:
-                if self.from_disk:
-                    sql = "CREATE TABLE {0} (id SERIAL, x REAL[], y {1},\
-                        img_name TEXT)".format(self.table_name, y_type)
-                else:
-                    sql = "CREATE TABLE {0} (id SERIAL, x REAL[], y {1})"\
-                        .format( self.table_name, y_type)
+                sql = "CREATE TABLE {0} (id SERIAL, {1}){2}"\
+                    .format(table_name, self._column_defs(),
+                            self._storage_clause())
                 self.db_exec(sql)
             except db.DatabaseError as e:
                 raise RuntimeError("{0} while creating {1} in db {2}.\n"
                                    "If the table already exists, you can use "
                                    "append=True to append more images to it."
-                                .format(e.message.strip(), self.table_name,
+                                .format(e.message.strip(), table_name,
                                         self.db_creds.db_name))
 
-            print "Created table {0} in {1} db".format(self.table_name,
+            print "Created table {0} in {1} db".format(table_name,
                 self.db_creds.db_name)
 
-        self.db_close()
+    def _merge_staging(self):
+        """
+        Moves the rows of the staging table into the table, and drops it, all
+            in one transaction
+        """
+        if not self.staging:
+            return
+
+        self.db_connect()
+        try:
+            self.db_exec("BEGIN", echo=False)
+            try:
+                self.db_exec("INSERT INTO {0} ({1}) SELECT {1} FROM {2}"
+                             .format(self.table_name,
+                                     ', '.join(self._columns()),
+                                     self._staging_table()))
+                self.db_exec("DROP TABLE {0}".format(self._staging_table()))
+                self.db_exec("COMMIT", echo=False)
+            except Exception:
+                self.db_exec("ROLLBACK", echo=False)
+                raise
+        finally:
+            self.db_close()
+
+    def _set_training(self, training, class_values=None, can_shuffle=False):
+        """
+        Sets the TrainingPreprocessor of the load, with its class_values
+            defaulting to class_values.  If the load can_shuffle and has no
+            split, its images are shuffled before they are packed, unless
+            the TrainingPreprocessor was created with shuffle=False.
+        """
+        if training is not None and training.class_values is None:
+            if class_values is None:
+                raise ValueError("TrainingPreprocessor needs class_values "
+                                 "when loading from a stream, from archives "
+                                 "or with nested_labels=True")
+            training = copy.copy(training)
+            training.class_values = sorted(class_values)
+        self.training = training
+        if training is not None and training.shuffle and can_shuffle and \
+                self.split is None:
+            self.split = DataSplit(shuffle=True)
+
+    def _finish_training(self):
+        """
+        Records the parameters of the training table in its summary table, in
+            the layout of training_preprocessor_dl()
+        """
+        if not self.training or (self.append and not self.resume):
+            return
+
+        label_datatype = self.label_datatype.replace('[]', '')
+        self.db_connect()
+        try:
+            # The buffer_size recorded is that of the largest buffer written,
+            #  which is less than buffer_size if every block was smaller
+            self.db_exec("SELECT max(array_upper(dependent_var, 1)) FROM {0}"
+                         .format(self.training.output_table), echo=False)
+            buffer_size = self.db_cur.fetchall()[0][0] or \
+                self.training.buffer_size
+            self.db_exec("DROP TABLE IF EXISTS {0}_summary"
+                         .format(self.training.output_table), echo=False)
+            self.db_exec("CREATE TABLE {0}_summary (source_table TEXT, "
+                         "output_table TEXT, dependent_varname TEXT, "
+                         "independent_varname TEXT, dependent_vartype TEXT, "
+                         "class_values {1}[], buffer_size INTEGER, "
+                         "normalizing_const REAL, num_classes INTEGER, "
+                         "distribution_rules TEXT, "
+                         "__internal_gpu_config__ TEXT)"
+                         .format(self.training.output_table, label_datatype))
+            class_values = self.training._padded_class_values()
+            self.db_exec("INSERT INTO {0}_summary VALUES (%s, %s, 'y', 'x', "
+                         "%s, %s::{1}[], %s, %s, %s, 'all_segments', "
+                         "'all_segments')"
+                         .format(self.training.output_table, label_datatype),
+                         (self.table_name, self.training.output_table,
+                          label_datatype.lower(), class_values,
+                          buffer_size,
+                          self.training.normalizing_const,
+                          len(class_values)))
+        finally:
+            self.db_close()
+
+    # Options for the table created, and for what is done once all images
+    #  are loaded (see the comments at the top of this file).  None or empty
+    #  means the database default, or nothing.
+    DISTRIBUTED_BY = None
+    STORAGE = None
+    INDEXES = ()
+    ANALYZE = False
+
+    def _storage_clause(self):
+        clause = ''
+        if self.STORAGE:
+            clause += ' WITH ({0})'.format(self.STORAGE)
+        if self.DISTRIBUTED_BY:
+            if self.DISTRIBUTED_BY.upper() == 'RANDOMLY':
+                clause += ' DISTRIBUTED RANDOMLY'
+            else:
+                clause += ' DISTRIBUTED BY ({0})'.format(self.DISTRIBUTED_BY)
+        return clause
+
+    def _finish_table(self):
+        """
+        Creates INDEXES and runs ANALYZE on the table, once it's loaded
+        """
+        if not self.INDEXES and not self.ANALYZE:
+            return
+
+        self.db_connect()
+        try:
+            for table_name in self._target_tables():
+                # Index names aren't schema qualified; they are always
+                #  created in the schema of their table, so only an index of
+                #  that name in the same schema means it already exists.
+                #  (CREATE INDEX IF NOT EXISTS needs postgres 9.5, which
+                #  greenplum isn't based on.)
+                table = table_name.split('.')[-1]
+                for column in self.INDEXES:
+                    index = '{0}_{1}_idx'.format(table, column)
+                    self.db_exec("SELECT 1 FROM pg_class i JOIN pg_class t "
+                                 "ON i.relnamespace = t.relnamespace WHERE "
+                                 "t.oid = %s::regclass AND i.relname = %s",
+                                 (table_name, index), echo=False)
+                    if not self.db_cur.fetchall():
+                        self.db_exec("CREATE INDEX {0} ON {1} ({2})"
+                                     .format(index, table_name, column))
+                if self.ANALYZE:
+                    self.db_exec("ANALYZE {0}".format(table_name))
+        finally:
+            self.db_close()
+
+    # Address segments use to reach the gpfdist server when gpfdist=True.  A
+    #  GPFDIST_HOST of None means socket.getfqdn(), and GPFDIST_PORT of 0
+    #  means any free port.
+    GPFDIST_HOST = None
+    GPFDIST_PORT = 0
+
+    def _gpfdist_load(self, serialize, tasks):
+        """
+        Loads into the table through a readable external table, whose
+            LOCATION is a gpfdist server in this process.  The workers run
+            serialize on each task, and the resulting blocks are handed out to
+            the segments as they request data.  Returns the number of rows
+            loaded.
+        """
+        name = '{0}_ext_{1}'.format(self.table_name.replace('.', '_'),
+                                    self._random_string().lower())
+        server = _GpfdistServer(('', self.GPFDIST_PORT), name,
+                                2 * self.num_workers)
+        host = self.GPFDIST_HOST or socket.getfqdn()
+        location = 'gpfdist://{0}:{1}/{2}'.format(host, server.server_port,
+                                                 name)
+        # A daemon, so that an error before shutdown() can't keep the
+        #  process alive
+        serving = threading.Thread(target=server.serve_forever)
+        serving.daemon = True
+        serving.start()
+
+        abort = threading.Event()
+        errors = []
+
+        def produce():
+            try:
+                for block, _, task_stats in self._bounded_imap(serialize,
+                                                               tasks):
+                    if abort.is_set():
+                        break
+                    server.put(block, abort)
+                    self._record_stats(task_stats)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                server.done.set()
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+
+        try:
+            self.db_connect()
+            try:
+                self.db_exec("BEGIN")
+                self.db_exec("CREATE READABLE EXTERNAL TABLE {0} ({1}) "
+                             "LOCATION ('{2}') FORMAT 'TEXT' (DELIMITER '|')"
+                             .format(name, self._column_defs(), location))
+                start = time.time()
+                self.db_exec("INSERT INTO {0} ({1}) SELECT * FROM {2}"
+                             .format(self.table_name,
+                                     ', '.join(self._columns()), name))
+                num_rows = self.db_cur.rowcount
+                producer.join()
+                self.stats['total']['copy_s'] += time.time() - start
+                if errors:
+                    raise errors[0]
+                self.db_exec("DROP EXTERNAL TABLE {0}".format(name))
+                self.db_exec("COMMIT")
+            except Exception:
+                self.db_exec("ROLLBACK")
+                raise
+        finally:
+            # Stops the producer too, if the load failed
+            abort.set()
+            server.shutdown()
+            server.server_close()
+            self.db_close()
+
+        return num_rows
+
+    def _threaded_load(self, serialize, tasks):
+        """
+        Loads the blocks the workers serialize with serialize through
+            copy_connections connections of this process, each running one
+            COPY at a time in its own thread.  The database can then be kept
+            busy with more concurrent COPYs than there are workers, and the
+            workers only do the CPU bound part of the load.
+        """
+        blocks = Queue.Queue(maxsize=2 * self.copy_connections)
+        stats_lock = threading.Lock()
+        errors = []
+
+        # Each thread gets its own copy of this loader, with its own
+        #  connection.  Copies kept from the last load (see persistent) hand
+        #  their connection over to the new ones.
+        copiers = []
+        for i in range(self.copy_connections):
+            copier = copy.copy(self)
+            copier.persistent = False
+            copier.pr_name = 'Copy-{0}'.format(i + 1)
+            copier.db_conn = copier.db_cur = None
+            if i < len(self._copiers):
+                old = self._copiers[i]
+                copier.db_conn, copier.db_cur = old.db_conn, old.db_cur
+                copier._db_used = old._db_used
+            copier._reset_task_stats()
+            copiers.append(copier)
+        for old in self._copiers[len(copiers):]:
+            old.db_close()
+        self._copiers = copiers if self.persistent else []
+
+        def copy_blocks(copier):
+            try:
+                copier.db_connect()
+                for block, unit, task_stats in iter(blocks.get, None):
+                    if errors:
+                        continue
+                    copier._reset_task_stats()
+                    copier._copy_into_db(_IterFile(copier._frame([block])),
+                                         task_stats['rows'], unit)
+                    task_stats['copy_s'] += copier.task_stats['copy_s']
+                    with stats_lock:
+                        self._record_stats(task_stats)
+            except Exception as e:
+                print "\nError in {0} while loading images"\
+                    .format(copier.pr_name)
+                print traceback.format_exc()
+                errors.append(e)
+                for _ in iter(blocks.get, None):
+                    pass
+            finally:
+                if not self.persistent:
+                    copier.db_close()
+
+        threads = [threading.Thread(target=copy_blocks, args=(copier,))
+                   for copier in copiers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for result in self._bounded_imap(serialize, tasks):
+                if errors:
+                    break
+                blocks.put(result)
+        finally:
+            for thread in threads:
+                blocks.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
 
     def load_dataset_from_np(self, data_x, data_y, table_name=None,
-                             append=False, label_datatype='TEXT'):
+                             append=False, label_datatype='TEXT',
+                             binary=False, no_temp_files=True, resume=False,
+                             gpfdist=False, x_datatype='REAL[]',
+                             preprocess=None, staging=False,
+                             copy_connections=None,
+                             training_preprocessor=None, split=None):
         """
         Loads a numpy array into db.  For append=False, creates a new table and
             loads the data.  For append=True, appends data to existing table.
@@ -455,19 +2938,55 @@ class ImageLoader:
             load in parallel.
         @data_x independent variable data, a numpy array of images.  Size of
             first dimension is number of images.  Rest of dimensions determined
-            by image resolution and number of channels.
-        @data_y dependent variable data (image classes), as an numpy array
+            by image resolution and number of channels.  Can also be an
+            np.memmap or the path to a .npy file.
+        @data_y dependent variable data (image classes), as an numpy array,
+            np.memmap or path to a .npy file
         @table_name Name of table in db to load data into
         @append Whether to create a new table (False) or append to an existing
             one (True).  If unspecified, default is False
         @label_datatype: If set will create table with the the column 'y' set
             to the datatype specified. Default is set to TEXT
+        @binary: Use the binary COPY format instead of text.  Default is False
+        @no_temp_files: Stream each block directly into the db (True), or write
+            it to a temporary file first (False).  Default is True
+        @resume: Record each loaded block in a manifest table, and skip blocks
+            already recorded there by a previous interrupted call.  Default is
+            False
+        @gpfdist: Load through an external table served to the Greenplum
+            segments by this process, instead of COPY.  Default is False
+        @x_datatype: Datatype of the image column x: REAL[], SMALLINT[] (for
+            integer images), or BYTEA (raw image buffer, with shape and dtype
+            columns).  Default is REAL[]
+        @preprocess: An ImagePreprocessor, applied to every image by the
+            workers before it is loaded.  Default is None
+        @staging: COPY into an unlogged staging table, and move its rows into
+            table_name in a single transaction once everything is loaded.
+            Default is False
+        @training_preprocessor: A TrainingPreprocessor, to also pack the images
+            into a table of mini-batch buffers while they are loaded.
+            Default is None
+        @split: A DataSplit, to split the images between several tables and/or
+            shuffle them.  Default is None
+        @copy_connections: Number of connections through which this process
+            COPYs the blocks serialized by the workers, instead of each worker
+            COPYing its own.  Default is None
         """
         start_time = time.time()
         self.mother = True
         self.from_disk = False
+        self.no_temp_files = no_temp_files
         self.append = append
         self.label_datatype = label_datatype
+        self.binary = binary
+        self.resume = resume
+        self.gpfdist = gpfdist
+        self.copy_connections = copy_connections
+        self.x_datatype = x_datatype
+        self.preprocess = preprocess
+        self.staging = staging
+        self.split = split
+        self.incremental = False
 
         if table_name:
             self.table_name = table_name
@@ -476,91 +2995,644 @@ class ImageLoader:
             raise ValueError("Must specify table_name either in ImageLoader"
                 " constructor or in load_dataset_from_np params!")
 
+        if isinstance(data_x, basestring):
+            data_x = np.load(data_x, mmap_mode='r')
+        if isinstance(data_y, basestring):
+            data_y = np.load(data_y, mmap_mode='r')
+
         # Flatten labels only for arrays with shape (n,1) o (1,n) since these
-        # shapes can be treated as individual labels
+        # shapes can be treated as individual labels.  As with
+        # load_dataset_from_stream, only labels with more than one dimension
+        # left are stored as arrays
         if data_y.ndim == 2 and (data_y.shape[0] == 1 or data_y.shape[1] == 1):
             data_y = data_y.flatten()
-        else:
+        elif data_y.ndim > 1:
             self.label_datatype = self.label_datatype + '[]'
 
+        if training_preprocessor and data_y.ndim > 1:
+            raise ValueError("TrainingPreprocessor needs one label per image "
+                             "in data_y")
+        class_values = None
+        if training_preprocessor:
+            class_values = np.unique(data_y).tolist()
+        self._set_training(training_preprocessor, class_values, True)
 
         self._validate_input_and_create_table(data_x, data_y)
 
-        data = zip(data_x, data_y)
-
-        if not self.pool:
-            print("Spawning {0} workers...".format(self.num_workers))
-            self.pool = Pool(processes=self.num_workers,
-                     initializer=init_worker,
-                     initargs=(current_process().pid,
-                               self.table_name,
-                               self.append,
-                               False,
-                               self.db_creds,
-                               False))
-
+        # The workers need to be forked after data_x and data_y are known, so
+        #  that they inherit the arrays rather than receiving pickled copies
+        #  (unless they are memory mapped, or kept, see _start_workers)
+        shared = self._start_workers(data_x, data_y)
 
-        datas = []
+        num_images = len(data_x)
+        rows = self._rows_per_file(
+            zip(self._preprocess(data_x[:self.SAMPLE_ROWS]),
+                data_y[:self.SAMPLE_ROWS]), num_images)
+        bounds = [(n, min(n + rows, num_images))
+                  for n in range(0, num_images, rows)]
+        bounds = [b for b in bounds
+                  if _rows_unit(*b) not in self.completed_units]
+        num_images = sum(stop - start for start, stop in bounds)
 
-        for n in range(0, len(data), self.ROWS_PER_FILE):
-            datas.append(data[n:n+self.ROWS_PER_FILE])
+        # With a split, each block is a list of row indices instead, loaded
+        #  into the table of its split
+        if self.split:
+            bounds = []
+            tables = self._target_tables()
+            for table, indices in zip(tables,
+                                      self.split.split_indices(data_y)):
+                print("{0} images for {1}".format(len(indices), table))
+                for index, n in enumerate(range(0, len(indices), rows)):
+                    unit = _split_unit(table, index)
+                    if unit not in self.completed_units:
+                        bounds.append((table, _call_np_rows_worker,
+                                       (unit, indices[n:n + rows])))
+            num_images = sum(len(task[1]) for _, _, task in bounds)
 
         #
-        # Each element in datas is a list of self.ROWS_PER_FILE rows
-        #
-        #  Shape of datas:  ( number of files, rows per file, ( x-dim, y-dim ) )
+        # Each element in bounds is the (start, stop) range of a block of
+        #  self.rows_per_file rows.
         #
-        #  ( inside x can also be a numpy tensor with several dimensions, but y
-        #    should just be a single scalar )
-        #
-        #  multiprocessing library will call _call_np_worker() in some worker for
-        #   each file, splitting the list of files up into roughly equal chunks
-        #   for each worker to handle.  For example, if there are 500 files and
-        #   5 workers, each will handle about 100 files, and _call_np_worker()
-        #   will be called 100 times, each time with a different file full
-        #   of images.
+        #  multiprocessing library will call _call_np_range_worker() in some
+        #   worker for each block, splitting the list of blocks up into roughly
+        #   equal chunks for each worker to handle.  For example, if there are
+        #   500 blocks and 5 workers, each will handle about 100 blocks, and
+        #   _call_np_range_worker() will be called 100 times, each time with a
+        #   different range of images.  Only the range is sent to the worker;
+        #   it reads the images themselves from its own inherited (or memory
+        #   mapped) view of data_x and data_y.  Workers kept from an earlier
+        #   load (see persistent) are sent the images of the block instead.
+        func = _call_split_worker if self.split else _call_np_range_worker
+        serialize = _serialize_np_range
+        imap = self._imap
+        if not shared:
+            if self.split:
+                bounds = ((table, _call_np_data_worker,
+                           (unit, data_x[indices], data_y[indices]))
+                          for table, _, (unit, indices) in bounds)
+            else:
+                bounds = ((start, data_x[start:stop], data_y[start:stop])
+                          for start, stop in bounds)
+                func = _call_np_block_worker
+                serialize = _serialize_np_block
+            imap = self._bounded_imap
 
+        self._start_stats()
         try:
-            self.pool.map(_call_np_worker, datas)
+            if self.gpfdist:
+                self._gpfdist_load(serialize, bounds)
+            elif self.copy_connections:
+                self._threaded_load(serialize, bounds)
+            else:
+                # The warm-up may replace self.pool, so it has to run first
+                bounds = self._warm_up(func, bounds)
+                for task_stats in imap(func, bounds):
+                    self._record_stats(task_stats)
         except(Exception) as e:
             self.terminate_workers()
             raise e
 
+        self._merge_staging()
+        self._finish_training()
+        self._finish_stats()
+        self._finish_table()
         end_time = time.time()
-        print("Done!  Loaded {0} images in {1}s"\
-            .format(len(data), end_time - start_time))
-
-        self.terminate_workers()
-
-    def call_disk_worker(self, label):
-        dir_name = os.path.join(self.root_dir,label)
-
-        filenames = os.listdir(dir_name)
-        data = []
-        first_image = Image.open(os.path.join(self.root_dir, label, filenames[0]))
-        for index, filename in enumerate(filenames):
-            image = Image.open(os.path.join(self.root_dir, label, filename))
-            x = np.array(image)
-            if x.shape != np.array(first_image).shape:
-                raise Exception("Images {0} and {1} in label {2} have different "
-                                "shapes {0}:{3} {1}:{4}.  Make sure that all the "
-                                "images are of the same shape."\
-                    .format(filenames[0], filename, label,
-                            first_image.shape, x.shape))
-
-            data.append((x, label, filename))
-            if (index % self.ROWS_PER_FILE) == (self.ROWS_PER_FILE - 1):
-                _call_np_worker(data)
-                data = []
-
-        if len(data) > 0:
-            _call_np_worker(data)
+        print("Done!  Loaded {0} images in {1}s ({2:.1f} images/s, "
+              "{3:.2f} MB/s)".format(num_images, end_time - start_time,
+                                     self.stats['total']['rows_per_s'],
+                                     self.stats['total']['mb_per_s']))
+
+        if not self.persistent:
+            self.terminate_workers()
+
+    def load_dataset_from_stream(self, source, table_name=None, append=False,
+                                 label_datatype='TEXT', binary=False,
+                                 x_key='x', y_key='y', no_temp_files=True,
+                                 resume=False, gpfdist=False,
+                                 x_datatype='REAL[]', preprocess=None,
+                                 staging=False, copy_connections=None,
+                                 training_preprocessor=None):
+        """
+        Loads a dataset which does not fit in memory into db, reading it one
+            block of ROWS_PER_FILE images at a time.  At most two blocks per
+            worker are read ahead of the workers, so memory use is bounded by
+            num_workers * ROWS_PER_FILE images regardless of dataset size.
+        @source One of: the path to a .npz archive; a (data_x, data_y) pair
+            where each is an .npy path, np.memmap or numpy array; or any
+            iterable (such as a generator) of (x_batch, y_batch) numpy arrays
+        @table_name Name of table in db to load data into
+        @append Whether to create a new table (False) or append to an existing
+            one (True).  If unspecified, default is False
+        @label_datatype: If set will create table with the the column 'y' set
+            to the datatype specified. Default is set to TEXT
+        @binary: Use the binary COPY format instead of text.  Default is False
+        @x_key, y_key: Names of the image and label arrays in a .npz archive
+        @no_temp_files: Stream each block directly into the db (True), or write
+            it to a temporary file first (False).  Default is True
+        @resume: Record each loaded block in a manifest table, and skip blocks
+            already recorded there by a previous interrupted call.  Skipped
+            blocks are still read from source, but not sent to the workers.
+            Default is False
+        @gpfdist: Load through an external table served to the Greenplum
+            segments by this process, instead of COPY.  Default is False
+        @x_datatype: Datatype of the image column x: REAL[], SMALLINT[] (for
+            integer images), or BYTEA (raw image buffer, with shape and dtype
+            columns).  Default is REAL[]
+        @preprocess: An ImagePreprocessor, applied to every image by the
+            workers before it is loaded.  Default is None
+        @staging: COPY into an unlogged staging table, and move its rows into
+            table_name in a single transaction once everything is loaded.
+            Default is False
+        @training_preprocessor: A TrainingPreprocessor, to also pack the images
+            into a table of mini-batch buffers while they are loaded.
+            Default is None
+        @copy_connections: Number of connections through which this process
+            COPYs the blocks serialized by the workers, instead of each worker
+            COPYing its own.  Default is None
+        """
+        start_time = time.time()
+        self.mother = True
+        self.from_disk = False
+        self.no_temp_files = no_temp_files
+        self.append = append
+        self.label_datatype = label_datatype
+        self.binary = binary
+        self.resume = resume
+        self.gpfdist = gpfdist
+        self.copy_connections = copy_connections
+        self.x_datatype = x_datatype
+        self.preprocess = preprocess
+        self.staging = staging
+        self.split = None
+        self.incremental = False
+
+        if table_name:
+            self.table_name = table_name
+
+        if not self.table_name:
+            raise ValueError("Must specify table_name either in ImageLoader"
+                " constructor or in load_dataset_from_stream params!")
+
+        # The first few images are read on their own, to check the labels
+        #  and (when ROWS_PER_FILE is None) estimate the size of each row
+        if isinstance(source, basestring):
+            sample = [next(_iter_npz_member(source, key, self.SAMPLE_ROWS),
+                           [])
+                      for key in (x_key, y_key)]
+        elif isinstance(source, tuple) and len(source) == 2:
+            data_x, data_y = [np.load(a, mmap_mode='r')
+                              if isinstance(a, basestring) else a
+                              for a in source]
+            if len(data_x) != len(data_y):
+                raise ValueError("Invalid dataset passed, number of labels in "
+                                 "data_y ({0}) does not match number of "
+                                 "images in data_x ({1})"\
+                    .format(len(data_y), len(data_x)))
+            sample = data_x[:self.SAMPLE_ROWS], data_y[:self.SAMPLE_ROWS]
+        else:
+            chunks = (chunk for chunk in source if len(chunk[0]) > 0)
+            sample = next(chunks, ([], []))
+            chunks = chain([sample], chunks)
+
+        sample = next(_iter_blocks([sample], self.SAMPLE_ROWS), None)
+        if sample is None:
+            raise ValueError("Invalid dataset passed, source is empty")
+        if sample[1].ndim > 1:
+            self.label_datatype = self.label_datatype + '[]'
+
+        self._set_training(training_preprocessor)
+        self._validate_input_and_create_table(*sample)
+
+        rows = self._rows_per_file(zip(self._preprocess(sample[0]),
+                                       sample[1]))
+        if isinstance(source, basestring):
+            chunks = izip(_iter_npz_member(source, x_key, rows),
+                          _iter_npz_member(source, y_key, rows))
+        elif isinstance(source, tuple) and len(source) == 2:
+            chunks = ((data_x[n:n + rows], data_y[n:n + rows])
+                      for n in range(0, len(data_x), rows))
+        blocks = _iter_blocks(chunks, rows)
+
+        self._start_workers()
+
+        num_images = [0]
+
+        def tasks():
+            start = 0
+            for x_block, y_block in blocks:
+                stop = start + len(x_block)
+                if _rows_unit(start, stop) not in self.completed_units:
+                    num_images[0] += len(x_block)
+                    yield start, x_block, y_block
+                start = stop
+
+        self._start_stats()
+        try:
+            if self.gpfdist:
+                self._gpfdist_load(_serialize_np_block, tasks())
+            elif self.copy_connections:
+                self._threaded_load(_serialize_np_block, tasks())
+            else:
+                for task_stats in self._bounded_imap(
+                        _call_np_block_worker,
+                        self._warm_up(_call_np_block_worker, tasks())):
+                    self._record_stats(task_stats)
+        except(Exception) as e:
+            self.terminate_workers()
+            raise e
+
+        self._merge_staging()
+        self._finish_training()
+        self._finish_stats()
+        self._finish_table()
+        end_time = time.time()
+        print("Done!  Loaded {0} images in {1}s ({2:.1f} images/s, "
+              "{3:.2f} MB/s)".format(num_images[0], end_time - start_time,
+                                     self.stats['total']['rows_per_s'],
+                                     self.stats['total']['mb_per_s']))
+
+        if not self.persistent:
+            self.terminate_workers()
+
+    def call_disk_worker(self, batch):
+        # For incremental loads, the decoding threads add a (label, img_name,
+        #  size, mtime, hash) row for each image to _index_rows
+        self._index_rows = [] if self.incremental else None
+        try:
+            rows, files, unit = self._decode_batch(batch)
+            if self.no_temp_files:
+                self._pipeline_load(rows, files, unit)
+            else:
+                _call_np_worker(list(rows), unit)
+        finally:
+            self._index_rows = None
+
+    def _decode_batch(self, batch):
+        """
+        Starts decoding a batch of images on the decoding threads.  Returns an
+            iterator over the decoded (x, label, filename) rows, in order,
+            along with the list of images and the manifest unit of the batch.
+        """
+        shape, unit, filenames = batch
+        files = [(filename, label, os.path.join(self.root_dir, label, filename))
+                 for label, filename in filenames]
+        return self._decode_samples(shape, files), files, unit
+
+    def _decode_samples(self, shape, samples):
+        """
+        Returns an iterator over the decoded (x, label, name) rows of samples,
+            a list of (name, label, source) tuples where source is either the
+            path of the image file, or a function returning its contents.
+            The images are decoded on the decoding threads.
+        """
+        def decode(sample):
+            filename, label, source = sample
+            start = time.time()
+            if callable(source):
+                x = self._load_image(filename, source())
+            elif self._index_rows is not None:
+                with open(source, 'rb') as f:
+                    data = f.read()
+                    mtime = os.fstat(f.fileno()).st_mtime
+                x = self._load_image(source, data)
+                self._index_rows.append((label, filename, len(data), mtime,
+                                         _content_hash(data)))
+            else:
+                x = self._load_image(source)
+            self._add_task_stat('decode_s', time.time() - start)
+            if x.shape != shape:
+                raise Exception("Image {0} in label {1} has shape {2}, but "
+                                "the first image loaded has shape {3}.  Make "
+                                "sure that all the images are of the same "
+                                "shape, or pass a preprocess with a size and "
+                                "mode to resize and convert them."\
+                                .format(filename, label, x.shape, shape))
+            return x, label, filename
+
+        if self._decode_pool is None:
+            self._decode_pool = ThreadPool(self.DECODE_THREADS)
+
+        return self._decode_pool.imap(decode, samples)
+
+    def _zip_archive(self, path):
+        """
+        Returns the zip archive at path, opened by the first task of the load
+            that reads from it in this worker
+        """
+        if path not in self._zip_archives:
+            self._zip_archives[path] = zipfile.ZipFile(path)
+        return self._zip_archives[path]
+
+    def call_archive_worker(self, task):
+        """
+        Loads the given samples of a zip archive, or all the samples of a tar
+            archive (if members is None), one block of rows images at a time,
+            except for the blocks whose index is in skip.
+        """
+        shape, path, index, members, rows, skip = task
+        if members is not None:
+            archive = self._zip_archive(path)
+            samples = iter([(name, label, partial(archive.read, name))
+                            for name, label in members])
+        else:
+            samples = _archive_samples(path)
+        while True:
+            block = list(islice(samples, rows))
+            if not block:
+                break
+            if index not in skip:
+                decoded = self._decode_samples(shape, block)
+                unit = _archive_unit(path, index)
+                if self.no_temp_files:
+                    self._pipeline_load(decoded, block, unit)
+                else:
+                    _call_np_worker(list(decoded), unit)
+            index += 1
+
+    # Extensions of the files loaded from label directories (None for all
+    #  files), and number of threads listing directories at once
+    EXTENSIONS = IMAGE_EXTENSIONS
+    SCAN_THREADS = 8
+
+    def _is_image(self, filename):
+        return self.EXTENSIONS is None or \
+            filename.lower().endswith(tuple(self.EXTENSIONS))
+
+    def _list_dir(self, path, find_dirs, cached=None, use_mtime=False):
+        """
+        Returns (mtime, subdirs, files) for the directory at path, each sorted,
+            or cached (an earlier result for path) if the directory hasn't
+            been modified since.  mtime is None unless use_mtime.  Without
+            scandir, an entry takes a stat to tell if it's a directory, so
+            unless find_dirs, every entry is taken to be a file, and
+            otherwise, only entries that don't look like images are checked.
+        """
+        mtime = os.stat(path).st_mtime if use_mtime else None
+        if cached is not None and mtime is not None and cached[0] == mtime:
+            return cached
+
+        subdirs, files = [], []
+        if scandir is not None:
+            for entry in scandir(path):
+                (subdirs if entry.is_dir() else files).append(entry.name)
+        else:
+            for name in os.listdir(path):
+                if find_dirs and not self._is_image(name) and \
+                        os.path.isdir(os.path.join(path, name)):
+                    subdirs.append(name)
+                else:
+                    files.append(name)
+        return mtime, sorted(subdirs), sorted(files)
+
+    def _scan_labels(self, root_dir, num_labels='all', nested=False,
+                     cache_path=None):
+        """
+        Yields (label, filenames) for each label directory under root_dir that
+            contains images, as soon as it has been listed, with up to
+            SCAN_THREADS directories being listed at once.  Labels are the
+            directories in root_dir, or with nested, the paths relative to
+            root_dir of all the directories under them.  Filenames are sorted,
+            so that batches are the same from one run to the next.  With
+            cache_path, the listing of every directory is saved to that file
+            at the end, and directories whose mtime hasn't changed since are
+            not listed again by the next scan.
+        """
+        cache = {}
+        if cache_path and os.path.exists(cache_path):
+            # Names are kept as latin-1, which round trips any byte string
+            with open(cache_path) as f:
+                saved = json.load(f, encoding='latin-1')
+            if saved['nested'] == nested:
+                for path, (mtime, subdirs, files) in saved['dirs'].items():
+                    cache[path.encode('latin-1')] = \
+                        [mtime, [name.encode('latin-1') for name in subdirs],
+                         [name.encode('latin-1') for name in files]]
+        use_mtime = cache_path is not None
+        listings = {}
+
+        listings[''] = self._list_dir(root_dir, True, cache.get(''),
+                                      use_mtime)
+        _, labels, files = listings['']
+        # Files in root_dir are skipped, so that the user can keep a tar.gz
+        #  file or other extraneous files there without causing any problems
+        for filename in files:
+            print("{0} is not a directory, skipping".format(filename))
+        if num_labels == 'all':
+            print "Found {0} label directories in {1}".format(len(labels),
+                                                              root_dir)
+        else:
+            labels = labels[:int(num_labels)]
+            print "Using first {0} label directories in {1}"\
+                .format(len(labels), root_dir)
+
+        results = Queue.Queue()
+
+        def list_dir(relpath):
+            try:
+                listing = self._list_dir(os.path.join(root_dir, relpath),
+                                         nested, cache.get(relpath),
+                                         use_mtime)
+                results.put((relpath, listing, None))
+            except Exception as e:
+                results.put((relpath, None, e))
+
+        pool = ThreadPool(self.SCAN_THREADS)
+        try:
+            for label in labels:
+                pool.apply_async(list_dir, (label,))
+            pending = len(labels)
+            while pending:
+                relpath, listing, error = results.get()
+                pending -= 1
+                if error is not None:
+                    raise error
+                listings[relpath] = listing
+                _, subdirs, files = listing
+                if nested:
+                    for subdir in subdirs:
+                        pool.apply_async(list_dir,
+                                         (os.path.join(relpath, subdir),))
+                        pending += 1
+                filenames = [f for f in files if self._is_image(f)]
+                if filenames:
+                    yield relpath, filenames
+        finally:
+            pool.terminate()
+
+        if cache_path:
+            tmp_path = '{0}.{1}'.format(cache_path, self._random_string())
+            with open(tmp_path, 'w') as f:
+                json.dump({'nested': nested, 'dirs': listings}, f,
+                          encoding='latin-1')
+            os.rename(tmp_path, cache_path)
+
+    def _incremental_files(self, files):
+        """
+        Filters files, an iterator over (label, filenames), down to the images
+            that aren't in the index table yet, or have changed since they
+            were loaded.  Images with the same size and mtime as when they
+            were loaded are skipped without reading them, and images with
+            only a new mtime are hashed to find out if their content has
+            changed.  The rows (and index entries) of the images of a label
+            that have changed are deleted, in one transaction, before the
+            label is yielded.
+        """
+        self.db_connect()
+        self.db_exec("SELECT now()", echo=False)
+        self._index_since = self.db_cur.fetchall()[0][0]
+        self.db_exec("SELECT label, img_name, size, mtime, hash FROM {0}"
+                     .format(self._index_table()), echo=False)
+        index = dict(((label, img_name), (size, mtime, content_hash))
+                     for label, img_name, size, mtime, content_hash
+                     in self.db_cur.fetchall())
+
+        num_new = num_changed = num_unchanged = 0
+        for label, filenames in files:
+            load, changed, touched = [], [], []
+            for filename in filenames:
+                entry = index.get((label, filename))
+                if entry is None:
+                    load.append(filename)
+                    continue
+                path = os.path.join(self.root_dir, label, filename)
+                st = os.stat(path)
+                size, mtime, content_hash = entry
+                if (st.st_size, st.st_mtime) == (size, mtime):
+                    num_unchanged += 1
+                elif st.st_size == size and \
+                        _content_hash(open(path, 'rb').read()) == content_hash:
+                    num_unchanged += 1
+                    touched.append((st.st_mtime, label, filename))
+                else:
+                    changed.append(filename)
+                    load.append(filename)
+
+            if changed or touched:
+                self.db_exec("BEGIN", echo=False)
+                try:
+                    # One DELETE per table for all the changed images of the
+                    #  label (psycopg2 passes the list as an ARRAY)
+                    if changed:
+                        self.db_exec("DELETE FROM {0} WHERE y = %s AND "
+                                     "img_name = ANY(%s)"
+                                     .format(self.table_name),
+                                     (label, changed), echo=False)
+                        self.db_exec("DELETE FROM {0} WHERE label = %s AND "
+                                     "img_name = ANY(%s)"
+                                     .format(self._index_table()),
+                                     (label, changed), echo=False)
+                    for mtime, label, filename in touched:
+                        self.db_exec("UPDATE {0} SET mtime = %s WHERE "
+                                     "label = %s AND img_name = %s"
+                                     .format(self._index_table()),
+                                     (mtime, label, filename), echo=False)
+                    self.db_exec("COMMIT", echo=False)
+                except Exception:
+                    self.db_exec("ROLLBACK", echo=False)
+                    raise
+
+            num_new += len(load) - len(changed)
+            num_changed += len(changed)
+            if load:
+                yield label, load
+        self.db_close()
+
+        print("Incremental load: {0} new, {1} changed and {2} unchanged "
+              "images".format(num_new, num_changed, num_unchanged))
+
+    # Labels shown for each group of duplicates found by an incremental load
+    MAX_DUPLICATES_SHOWN = 10
+
+    def _find_duplicates(self):
+        """
+        Sets self.duplicates to a list of (hash, names) for each image loaded
+            by the last incremental load whose content is identical to that of
+            an image under another label, where names lists each of them as
+            'label/img_name'
+        """
+        self.db_connect()
+        self.db_exec("SELECT hash, array_agg(label || '/' || img_name) "
+                     "FROM {0} WHERE hash IN (SELECT hash FROM {0} "
+                     "WHERE loaded_at >= %s) GROUP BY hash "
+                     "HAVING count(DISTINCT label) > 1"
+                     .format(self._index_table()), (self._index_since,),
+                     echo=False)
+        self.duplicates = [(content_hash, sorted(names))
+                           for content_hash, names in self.db_cur.fetchall()]
+        self.db_close()
+
+        if self.duplicates:
+            print("Warning: found {0} sets of identical images under "
+                  "different labels:".format(len(self.duplicates)))
+            for content_hash, names in \
+                    self.duplicates[:self.MAX_DUPLICATES_SHOWN]:
+                print("    {0}".format(', '.join(names)))
+
+    def _pipeline_load(self, rows, files, unit=None):
+        """
+        Streams rows into the db with one COPY, while a serializer thread
+            keeps formatting the next PIPELINE_CHUNK rows and the decoding
+            threads behind rows keep decoding.  Any error raised while
+            decoding or serializing is raised again from inside the COPY, so
+            that the COPY is aborted rather than committing part of the batch.
+        """
+        chunks = Queue.Queue(maxsize=self.PIPELINE_DEPTH)
+        stop = threading.Event()
+        finished = threading.Event()
+        errors = []
+
+        def serialize():
+            try:
+                chunk = []
+                for row in rows:
+                    if stop.is_set():
+                        break
+                    chunk.append(row)
+                    if len(chunk) == self.PIPELINE_CHUNK:
+                        chunks.put(self._serialize(chunk))
+                        chunk = []
+                if chunk and not stop.is_set():
+                    chunks.put(self._serialize(chunk))
+            except Exception as e:
+                print "\nError in {0} while loading images".format(self.pr_name)
+                print traceback.format_exc()
+                errors.append(e)
+            finally:
+                chunks.put(None)
+
+        def serialized():
+            for chunk in iter(chunks.get, None):
+                yield chunk
+            finished.set()
+            if errors:
+                raise errors[0]
+
+        serializer = threading.Thread(target=serialize)
+        serializer.daemon = True
+        serializer.start()
+
+        try:
+            self._copy_into_db(_IterFile(self._frame(serialized())),
+                               len(files), unit)
+        except Exception as e:
+            stop.set()
+            while not finished.is_set() and chunks.get() is not None:
+                pass
+            raise errors[0] if errors else e
+        finally:
+            serializer.join()
 
     def load_dataset_from_disk(self, root_dir, table_name, num_labels='all',
-                               append=False, label_datatype='TEXT'):
+                               append=False, label_datatype='TEXT',
+                               binary=False, no_temp_files=True, resume=False,
+                               gpfdist=False, x_datatype='REAL[]',
+                               preprocess=None, staging=False,
+                               copy_connections=None, incremental=False,
+                               nested_labels=False, scan_cache=None,
+                               training_preprocessor=None, split=None):
         """
         Load images from disk into a greenplum database table. All the images
-            should be of the same shape.
+            should be of the same shape, unless preprocess resizes them.
         @root_dir: Location of the dir which contains all the labels and their
             associated images. Can be relative or absolute. Each label needs to
             have it's own dir and should contain only images inside it's own dir.
@@ -573,63 +3645,543 @@ class ImageLoader:
             existing table.
         @label_datatype: If set will create table with the the column 'y' set
             to the datatype specified. Default is set to TEXT
+        @binary: Use the binary COPY format instead of text.  Default is False
+        @no_temp_files: Stream each batch directly into the db (True), or write
+            it to a temporary file first (False).  Default is True
+        @resume: Record each loaded batch in a manifest table, and skip batches
+            already recorded there by a previous interrupted call.  Default is
+            False
+        @gpfdist: Load through an external table served to the Greenplum
+            segments by this process, instead of COPY.  Default is False
+        @x_datatype: Datatype of the image column x: REAL[], SMALLINT[] (for
+            integer images), or BYTEA (raw image buffer, with shape and dtype
+            columns).  Default is REAL[]
+        @preprocess: An ImagePreprocessor, applied to every image by the
+            workers before it is loaded.  Default is None
+        @staging: COPY into an unlogged staging table, and move its rows into
+            table_name in a single transaction once everything is loaded.
+            Default is False
+        @training_preprocessor: A TrainingPreprocessor, to also pack the images
+            into a table of mini-batch buffers while they are loaded.
+            Default is None
+        @split: A DataSplit, to split the images between several tables and/or
+            shuffle them.  Default is None
+        @copy_connections: Number of connections through which this process
+            COPYs the blocks serialized by the workers, instead of each worker
+            COPYing its own.  Default is None
+        @incremental: Only load the images that are new, or have changed,
+            since the last incremental load into table_name, keeping track of
+            them in an index table.  Images identical to images under other
+            labels are listed in self.duplicates.  Default is False
+        @nested_labels: Use every directory under root_dir that contains
+            images as a label, named by its path relative to root_dir (eg.
+            'animals/cat'), rather than only the directories in root_dir.
+            Default is False
+        @scan_cache: Path of a file in which to keep the listing of every
+            directory scanned, so that the next load only lists directories
+            modified since.  Default is None
         """
         start_time = time.time()
         self.mother = True
         self.append = append
-        self.no_temp_files = False
+        self.no_temp_files = no_temp_files
         self.table_name = table_name
         self.label_datatype = label_datatype
+        self.binary = binary
+        self.resume = resume
+        self.gpfdist = gpfdist
+        self.copy_connections = copy_connections
+        self.x_datatype = x_datatype
+        self.preprocess = preprocess
+        self.staging = staging
+        self.incremental = incremental
+        self.split = split
+        self.duplicates = []
         self.from_disk = True
+        self.root_dir = root_dir
+        class_values = None
+        if training_preprocessor and not nested_labels:
+            class_values = self._list_dir(root_dir, True)[1]
+            if num_labels != 'all':
+                class_values = class_values[:int(num_labels)]
+        self._set_training(training_preprocessor, class_values, True)
         self._validate_input_and_create_table()
 
-        self.root_dir = root_dir
-        subdirs = os.listdir(root_dir)
+        # Loading starts as soon as the first label directory has been listed,
+        #  while the others are still being listed.  The workers are forked
+        #  before the threads listing the directories are started.
+        self._start_workers()
+        try:
+            files = self._scan_labels(root_dir, num_labels, nested_labels,
+                                      scan_cache)
+            if self.incremental:
+                files = self._incremental_files(files)
 
+            first = next(files, None)
+            if first is not None:
+                label, filenames = first
+                first_image = self._load_image(os.path.join(root_dir, label,
+                                                            filenames[0]))
+                shape = first_image.shape
+                rows = self._rows_per_file([(first_image, label,
+                                             filenames[0])])
+        except(Exception) as e:
+            self.terminate_workers()
+            raise e
+
+        if first is None:
+            if not self.persistent:
+                self.terminate_workers()
+            if self.incremental:
+                print("Done!  No new or changed images in {0}"\
+                    .format(root_dir))
+                return
+            raise ValueError("No images found in {0}".format(root_dir))
+
+        # Batches are handed out lazily, a couple per worker at a time (see
+        #  _bounded_imap), so whichever worker is free next takes the next
+        #  batch.  This keeps every worker busy even when there are fewer
+        #  labels than workers, or when most of the images are under a
+        #  single label.
+        #
+        # With a split, the images of each label are split between the
+        #  tables as soon as the label is listed, unless they are shuffled,
+        #  which takes the images of every label.
         labels = []
-        # Prune files from directory listing, only use actual sub-directories
-        #  This allows the user to keep a tar.gz file or other extraneous files
-        #  in the root directory without causing any problems.
-        for subdir in subdirs:
-            if os.path.isdir(os.path.join(root_dir,subdir)):
-                labels.append(subdir)
+        tables = self._target_tables()
+
+        def blocks(unit, table, files):
+            for index, n in enumerate(range(0, len(files), rows)):
+                if unit(index) not in self.completed_units:
+                    yield table, (shape, unit(index), files[n:n + rows])
+
+        def batches():
+            shuffled = [[] for _ in tables]
+            for label, filenames in chain([first], files):
+                labels.append(label)
+                if not self.split:
+                    for batch in blocks(partial(_label_unit, label), None,
+                                        [(label, f) for f in filenames]):
+                        yield batch
+                    continue
+                for table, part, names in zip(
+                        tables, shuffled,
+                        self.split.split_files(label, filenames)):
+                    if self.split.shuffle:
+                        part.extend([(label, name) for name in names])
+                        continue
+                    for batch in blocks(partial(_split_unit, table, label),
+                                        table, [(label, f) for f in names]):
+                        yield batch
+            # The labels are listed in whatever order their listing threads
+            #  finish, so the images are sorted before they are shuffled, for
+            #  the order (and the units of resume=True) to depend on the seed
+            #  alone
+            if self.split and self.split.shuffle:
+                for table, part in zip(tables, shuffled):
+                    for batch in blocks(partial(_split_unit, table), table,
+                                        self.split.shuffled(sorted(part),
+                                                            table)):
+                        yield batch
+
+        self._start_stats()
+        try:
+            if self.gpfdist:
+                self._gpfdist_load(_serialize_disk_batch,
+                                   (batch for _, batch in batches()))
+            elif self.copy_connections:
+                self._threaded_load(_serialize_disk_batch,
+                                    (batch for _, batch in batches()))
             else:
-                print("{0} is not a directory, skipping".format(subdir))
+                if self.split:
+                    func = _call_split_worker
+                    tasks = ((table, _call_disk_worker, batch)
+                             for table, batch in batches())
+                else:
+                    func = _call_disk_worker
+                    tasks = (batch for _, batch in batches())
+                tasks = self._warm_up(func, tasks)
+                for task_stats in self._bounded_imap(func, tasks):
+                    self._record_stats(task_stats)
+        except(Exception) as e:
+            self.terminate_workers()
+            raise e
 
-        if num_labels == 'all':
-            print('number of labels = {}'.format(len(labels)))
-            num_labels = len(labels)
-            print "Found {0} image labels in {1}".format(num_labels, root_dir)
-        else:
-            num_labels = int(num_labels)
-            labels = labels[:num_labels]
-            print "Using first {0} image labels in {1}".format(num_labels,
-                                                               root_dir)
+        self._merge_staging()
+        self._finish_training()
+        self._finish_stats()
+        self._finish_table()
+        if self.incremental:
+            self._find_duplicates()
+        end_time = time.time()
+        print("Done!  Loaded {0} images in {1} image categories in {2}s "
+              "({3:.1f} images/s, {4:.2f} MB/s)"\
+            .format(self.stats['total']['rows'], len(labels),
+                    end_time - start_time,
+                    self.stats['total']['rows_per_s'],
+                    self.stats['total']['mb_per_s']))
 
-        if not self.pool:
-            print("Spawning {0} workers...".format(self.num_workers))
-            self.pool = Pool(processes=self.num_workers,
-                             initializer=init_worker,
-                             initargs=(current_process().pid,
-                                       self.table_name,
-                                       self.append,
-                                       self.no_temp_files,
-                                       self.db_creds,
-                                       self.from_disk,
-                                       root_dir))
+        if not self.persistent:
+            self.terminate_workers()
+
+    def load_dataset_from_archive(self, archives, table_name, append=False,
+                                  label_datatype='TEXT', binary=False,
+                                  no_temp_files=True, resume=False,
+                                  x_datatype='REAL[]', preprocess=None,
+                                  staging=False, training_preprocessor=None):
+        """
+        Load images from tar or zip archives into a database table, without
+            extracting them.  All the images should be of the same shape,
+            unless preprocess resizes them.
+        @archives: Path of an archive, a glob pattern matching several (such
+            as the shards of a WebDataset, eg. 'train-*.tar'), or a list of
+            paths.  Tar archives can be compressed with gzip or bzip2.  The
+            label of each image is the contents of the member with the same
+            name and a .cls extension if there is one, or else the name of
+            the directory containing the image in the archive.
+        @table_name: Name of destination table in db
+        @append: If set to true, do not create a new table but append to an
+            existing table.
+        @label_datatype: If set will create table with the the column 'y' set
+            to the datatype specified. Default is set to TEXT
+        @binary: Use the binary COPY format instead of text.  Default is False
+        @no_temp_files: Stream each batch directly into the db (True), or write
+            it to a temporary file first (False).  Default is True
+        @resume: Record each loaded batch in a manifest table, and skip batches
+            already recorded there by a previous interrupted call.  Default is
+            False
+        @x_datatype: Datatype of the image column x: REAL[], SMALLINT[] (for
+            integer images), or BYTEA (raw image buffer, with shape and dtype
+            columns).  Default is REAL[]
+        @preprocess: An ImagePreprocessor, applied to every image by the
+            workers before it is loaded.  Default is None
+        @staging: COPY into an unlogged staging table, and move its rows into
+            table_name in a single transaction once everything is loaded.
+            Default is False
+        @training_preprocessor: A TrainingPreprocessor, to also pack the images
+            into a table of mini-batch buffers while they are loaded.
+            Default is None
+        """
+        start_time = time.time()
+        self.mother = True
+        self.append = append
+        self.no_temp_files = no_temp_files
+        self.table_name = table_name
+        self.label_datatype = label_datatype
+        self.binary = binary
+        self.resume = resume
+        self.gpfdist = False
+        self.copy_connections = None
+        self.x_datatype = x_datatype
+        self.preprocess = preprocess
+        self.staging = staging
+        self.split = None
+        self.incremental = False
+        self.from_disk = True
+
+        if isinstance(archives, basestring):
+            archives = sorted(glob.glob(archives)) or [archives]
+        for path in archives:
+            if not os.path.isfile(path):
+                raise ValueError("Archive {0} not found".format(path))
+
+        self._set_training(training_preprocessor)
+        self._validate_input_and_create_table()
+
+        first = None
+        for path in archives:
+            samples = _archive_samples(path)
+            first = next(samples, None)
+            samples.close()
+            if first is not None:
+                break
+        if first is None:
+            raise ValueError("No images found in {0}".format(
+                ', '.join(archives)))
+
+        name, label, read = first
+        first_image = self._load_image(name, read())
+        shape = first_image.shape
+        self._start_workers()
+        rows = self._rows_per_file([(first_image, label, name)])
+
+        # Each tar archive is one task, as it can only be read from the
+        #  start, so tar shards are loaded in parallel by different workers.
+        #  Zip archives can be read in any order, and are split into one
+        #  task per block, like a directory;  their samples are listed once
+        #  here, and each task is given the names of its members.
+        completed = {}
+        for unit in self.completed_units:
+            if unit.startswith('archive/'):
+                path, index = unit[len('archive/'):].rsplit('/', 1)
+                completed.setdefault(path, set()).add(int(index))
+        tasks = []
+        for path in archives:
+            skip = frozenset(completed.get(path, ()))
+            if _is_zip(path):
+                members = [(name, label) for name, label, _ in
+                           _archive_samples(path)]
+                tasks += [(shape, path, index, members[n:n + rows], rows,
+                           frozenset())
+                          for index, n in enumerate(range(0, len(members),
+                                                          rows))
+                          if index not in skip]
+            else:
+                tasks.append((shape, path, 0, None, rows, skip))
+
+        self._start_stats()
         try:
-            self.pool.map(_call_disk_worker, labels)
+            tasks = self._warm_up(_call_archive_worker, tasks)
+            for task_stats in self._imap(_call_archive_worker, tasks):
+                self._record_stats(task_stats)
         except(Exception) as e:
             self.terminate_workers()
             raise e
 
-        self.pool.map(_worker_cleanup, [0] * self.num_workers)
+        self._merge_staging()
+        self._finish_training()
+        self._finish_stats()
+        self._finish_table()
+        end_time = time.time()
+        print("Done!  Loaded {0} images from {1} archives in {2}s "
+              "({3:.1f} images/s, {4:.2f} MB/s)"\
+            .format(self.stats['total']['rows'], len(archives),
+                    end_time - start_time, self.stats['total']['rows_per_s'],
+                    self.stats['total']['mb_per_s']))
+
+        if not self.persistent:
+            self.terminate_workers()
+
+    def export_block(self, task):
+        """
+        COPYs one block of rows of the table out of the database, and decodes
+            their images into the file being exported to.  Returns their
+            labels, or None if the table has no y column.
+        """
+        offset, num_rows, start_id, stop_id = task
+        export = self.export
+        shape = tuple(export['shape'])
+        columns = 'x, y' if export['y_datatype'] else 'x'
+        condition = 'id >= {0}'.format(start_id)
+        if stop_id is not None:
+            condition += ' AND id < {0}'.format(stop_id)
+
+        start = time.time()
+        buf = io.BytesIO()
+        self.db_cur.copy_expert(
+            "COPY (SELECT {0} FROM {1} WHERE {2} ORDER BY id) TO STDOUT{3}"\
+                .format(columns, self.table_name, condition,
+                        " WITH BINARY" if export['binary'] else ""), buf)
+        data = buf.getvalue()
+        self._add_task_stat('copy_s', time.time() - start)
+        self._add_task_stat('bytes', len(data))
+
+        start = time.time()
+        x_block = self._export_x[offset:offset + num_rows]
+        x_datatype = export['x_datatype']
+        size = int(np.prod(shape))
+        if x_datatype == 'BYTEA':
+            stored = np.dtype(export['stored_dtype']).newbyteorder('<')
+        elif x_datatype == 'SMALLINT[]':
+            elem_dtype = '>i2'
+        else:
+            elem_dtype = '>f4'
+
+        if export['binary']:
+            rows = _copy_tuples(data)
+        else:
+            rows = (line.split('\t') for line in data.splitlines())
+        labels = []
+        i = -1
+        for i, fields in enumerate(rows):
+            if i >= num_rows:
+                break
+            if export['binary']:
+                pos, length = fields[0]
+                if x_datatype == 'BYTEA':
+                    x = np.frombuffer(data, stored, length // stored.itemsize,
+                                      pos)
+                else:
+                    x = _decode_binary_array(data, pos, elem_dtype)
+                if len(fields) > 1:
+                    labels.append(_decode_binary_field(data, fields[1],
+                                                       export['y_datatype']))
+            else:
+                if x_datatype == 'BYTEA':
+                    x = np.frombuffer(
+                        binascii.unhexlify(_unescape_copy_text(fields[0])[2:]),
+                        stored)
+                else:
+                    x = np.fromstring(fields[0].translate(None, '{}'),
+                                      np.float64, sep=',')
+                if len(fields) > 1:
+                    labels.append(_decode_text_field(fields[1],
+                                                     export['y_datatype']))
+
+            # Only arrays decoded from binary COPY have a shape of their own
+            if x.ndim == 1 and x.size == size and \
+                    (x_datatype == 'BYTEA' or not export['binary']):
+                x = x.reshape(shape)
+            if x.shape != shape:
+                raise ValueError("Image {0} of {1} has shape {2}, but the "
+                                 "first image has shape {3}.  Only tables of "
+                                 "images of the same shape can be exported."\
+                    .format(offset + i, self.table_name, x.shape, shape))
+            x_block[i] = x
+        if i + 1 != num_rows:
+            raise RuntimeError("Expected {0} rows from {1} with {2}, got "
+                               "{3}.  Was the table modified during the "
+                               "export?"\
+                .format(num_rows, self.table_name, condition, i + 1))
+
+        y_block = None
+        if export['y_datatype']:
+            y_block = np.array(labels)
+            y_dtype = _native_dtype(export['y_datatype'])
+            if y_dtype is not None and None not in labels:
+                y_block = y_block.astype(y_dtype)
+        self._add_task_stat('decode_s', time.time() - start)
+        self._add_task_stat('rows', num_rows)
+
+        self._export_x.flush()
+        return y_block
+
+    def export_table_to_np(self, table_name, x_path=None, binary=True,
+                           dtype=None):
+        """
+        Reads an image table back into numpy arrays.  The table is split into
+            blocks of ROWS_PER_FILE rows by id, which the workers COPY out of
+            the database in parallel and decode.  Rows are returned in id
+            order.  All of the images must have the same shape.
+        @table_name: Name of the table, with an id column, an x column of
+            type REAL[], SMALLINT[] or BYTEA (with shape and dtype columns),
+            and optionally a y column, as created by the load functions
+        @x_path: Path of a .npy file to write the images to.  The workers
+            write to it directly, and the images are returned memory mapped
+            from it.  Default is None, for a temporary file in /tmp, which
+            is removed once the export is done
+        @binary: Use the binary COPY format, unless the datatype of y isn't
+            supported by it.  Default is True
+        @dtype: Numpy dtype of the images returned.  Default is None, for
+            float32 (REAL[]), int16 (SMALLINT[]), or the dtype they were
+            loaded with (BYTEA)
+        Returns (data_x, data_y), with data_y None if there is no y column.
+        """
+        start_time = time.time()
+        self.mother = True
+        self.table_name = table_name
+        self.from_disk = False
+        self.no_temp_files = True
+
+        self.db_connect()
+        self.db_exec("SELECT attname, format_type(atttypid, atttypmod) FROM "
+                     "pg_attribute WHERE attrelid = %s::regclass AND "
+                     "attnum > 0 AND NOT attisdropped", (table_name,),
+                     echo=False)
+        types = dict((name, datatype.split('(')[0])
+                     for name, datatype in self.db_cur.fetchall())
+        if 'x' not in types or 'id' not in types:
+            raise ValueError("Table {0} has no x or id column".format(
+                table_name))
+        x_datatype = _x_datatype(types['x'])
+        y_datatype = types.get('y')
+
+        self.db_exec("SELECT count(*) FROM {0}".format(table_name),
+                     echo=False)
+        num_images = self.db_cur.fetchall()[0][0]
+        if num_images == 0:
+            raise ValueError("Table {0} is empty".format(table_name))
+
+        stored_dtype = None
+        if x_datatype == 'BYTEA':
+            self.db_exec("SELECT shape, dtype FROM {0} ORDER BY id LIMIT 1"\
+                .format(table_name), echo=False)
+            shape, stored_dtype = self.db_cur.fetchall()[0]
+            shape = tuple(shape)
+            dtype = dtype or stored_dtype
+        else:
+            self.db_exec("SELECT array_dims(x) FROM {0} ORDER BY id LIMIT 1"\
+                .format(table_name), echo=False)
+            dims = self.db_cur.fetchall()[0][0]
+            shape = tuple(int(upper) - int(lower) + 1 for lower, upper in
+                          [dim.split(':') for dim in dims[1:-1].split('][')])
+            dtype = dtype or ('int16' if x_datatype == 'SMALLINT[]'
+                              else 'float32')
+        dtype = np.dtype(dtype)
+
+        if binary and y_datatype:
+            try:
+                _binary_type(y_datatype)
+            except ValueError:
+                print("Datatype {0} of y is not supported by binary COPY, "
+                      "exporting in text format".format(y_datatype))
+                binary = False
+
+        if self.ROWS_PER_FILE:
+            rows = self.ROWS_PER_FILE
+        else:
+            rows = max(1, self.BYTES_PER_FILE //
+                       (int(np.prod(shape)) * dtype.itemsize))
+        self.rows_per_file = rows
+
+        # The first id of each block, found in one pass over the ids, so that
+        #  every block knows where its rows go even if the ids have gaps
+        self.db_exec("SELECT id FROM (SELECT id, row_number() OVER "
+                     "(ORDER BY id) - 1 AS n FROM {0}) AS ids WHERE n % {1} "
+                     "= 0 ORDER BY id".format(table_name, rows), echo=False)
+        starts = [row[0] for row in self.db_cur.fetchall()]
+        self.db_close()
+        tasks = [(i * rows, min(rows, num_images - i * rows), start_id,
+                  starts[i + 1] if i + 1 < len(starts) else None)
+                 for i, start_id in enumerate(starts)]
+
+        # The workers can't write to the memory of this process, so they always
+        #  decode into a file they all map.  A temporary one can be removed as
+        #  soon as it is mapped here, but the workers open it by path.
+        remove = x_path is None
+        if remove:
+            x_path = os.path.join('/tmp', 'madlib_{0}.npy'.format(
+                self._random_string()))
+        data_x = np.lib.format.open_memmap(x_path, 'w+', dtype,
+                                           (num_images,) + shape)
+        x_file = _memmap_spec(data_x)
+        self.export = {'x_datatype': x_datatype, 'y_datatype': y_datatype,
+                       'shape': shape, 'dtype': dtype.str,
+                       'stored_dtype': stored_dtype, 'binary': binary,
+                       'x_file': x_file}
 
+        print("Exporting {0} images of shape {1} from {2}"\
+            .format(num_images, shape, table_name))
+        self._start_workers()
+        self._start_stats()
+        y_blocks = []
+        try:
+            for y_block, task_stats in \
+                    self._bounded_imap(_call_export_worker, tasks):
+                y_blocks.append(y_block)
+                self._record_stats(task_stats)
+        except(Exception) as e:
+            self.terminate_workers()
+            raise e
+        finally:
+            self.export = None
+            if remove:
+                os.remove(x_path)
+
+        self._finish_stats()
+        data_y = np.concatenate(y_blocks) if y_datatype else None
+        if not remove:
+            data_x.flush()
         end_time = time.time()
-        print("Done!  Loaded {0} image categories in {1}s"\
-            .format(len(labels), end_time - start_time))
+        print("Done!  Exported {0} images from {1} in {2}s "
+              "({3:.1f} images/s, {4:.2f} MB/s)"\
+            .format(num_images, table_name, end_time - start_time,
+                    self.stats['total']['rows_per_s'],
+                    self.stats['total']['mb_per_s']))
 
-        self.terminate_workers()
+        if not self.persistent:
+            self.terminate_workers()
+        return data_x, data_y
 
 def main():
     parser = argparse.ArgumentParser(description='Madlib Image Loader',
@@ -638,6 +4190,11 @@ def main():
                         dest='root_dir', default='.',
                         help='Root directory of image directories')
 
+    parser.add_argument('--archives', action='store',
+                        dest='archives', default=None,
+                        help='Load from tar or zip archives matching this '
+                             'glob pattern instead of ROOT_DIR')
+
     parser.add_argument('-n', '--num-labels', action='store',
                         dest='num_labels', default='all',
                         help='Number of image labels (categories) to load.')
@@ -656,7 +4213,14 @@ def main():
 
     parser.add_argument('-w', '--num-workers', action='store',
                         dest='num_workers', default=5,
-                        help='Name of parallel workers.')
+                        help='Name of parallel workers, or auto to choose '
+                             'them during a warm-up.')
+
+    parser.add_argument('-R', '--rows-per-file', action='store',
+                        dest='rows_per_file', default=ImageLoader.ROWS_PER_FILE,
+                        help='Number of images loaded per COPY, or auto for '
+                             'blocks of about {0} bytes'
+                             .format(ImageLoader.BYTES_PER_FILE))
 
     parser.add_argument('-p', '--port', action='store',
                         dest='port', default=5432,
@@ -674,27 +4238,272 @@ def main():
                         dest='password', default=None,
                         help='database user password')
 
-#   This option is not working yet
-#    parser.add_argument('-m', '--no-temp-files', action='store_true',
-#                        dest='no_temp_files', default=False,
-#                        help="no temporary files, construct all image tables "
-#                             " in-memory")
+    parser.add_argument('-b', '--binary', action='store_true',
+                        dest='binary', default=False,
+                        help='Use binary COPY format instead of text')
+
+    parser.add_argument('-x', '--x-datatype', action='store',
+                        dest='x_datatype', default='REAL[]',
+                        help='SQL datatype of image column: REAL[], '
+                             'SMALLINT[] or BYTEA')
+
+    def numbers(s, type=float):
+        values = [type(v) for v in s.split(',')]
+        return values[0] if len(values) == 1 else values
+
+    parser.add_argument('--resize', action='store', dest='resize',
+                        default=None, type=lambda s: numbers(s, int),
+                        help='resize images to HEIGHT,WIDTH, or so that the '
+                             'shorter side is RESIZE')
+
+    parser.add_argument('--crop', action='store', dest='crop', default=None,
+                        type=lambda s: numbers(s, int),
+                        help='crop HEIGHT,WIDTH (or CROP,CROP) from the center '
+                             'of each image')
+
+    parser.add_argument('--mode', action='store', dest='mode', default=None,
+                        choices=['RGB', 'L'],
+                        help='convert images to RGB or grayscale')
+
+    parser.add_argument('--scale', action='store_true', dest='scale',
+                        default=False,
+                        help='scale pixel values to [0, 1]')
+
+    parser.add_argument('--mean', action='store', dest='mean', default=None,
+                        type=numbers,
+                        help='comma separated mean to subtract from each '
+                             'channel')
+
+    parser.add_argument('--std', action='store', dest='std', default=None,
+                        type=numbers,
+                        help='comma separated std to divide each channel by')
+
+    parser.add_argument('--decoder', action='store', dest='decoder',
+                        default=ImageLoader.DECODER,
+                        choices=ImageLoader.DECODERS,
+                        help='image decoder')
+
+    parser.add_argument('-g', '--gpfdist', action='store_true',
+                        dest='gpfdist', default=False,
+                        help='Greenplum only: load through an external table '
+                             'served to the segments by this process')
+
+    parser.add_argument('--distributed-by', action='store',
+                        dest='distributed_by', default=None,
+                        help='Greenplum only: distribution key of the table, '
+                             'or RANDOMLY')
+
+    parser.add_argument('--storage', action='store', dest='storage',
+                        default=None,
+                        help='storage parameters of the table, eg. '
+                             '"appendonly=true, orientation=column, '
+                             'compresstype=zlib"')
+
+    parser.add_argument('--index', action='append', dest='indexes',
+                        default=[],
+                        help='column to index once the images are loaded '
+                             '(can be repeated)')
+
+    parser.add_argument('--analyze', action='store_true', dest='analyze',
+                        default=False,
+                        help='run ANALYZE on the table once the images are '
+                             'loaded')
+
+    parser.add_argument('--staging', action='store_true', dest='staging',
+                        default=False,
+                        help='load into an unlogged staging table, and move '
+                             'the images into the table in one transaction '
+                             'at the end')
+
+    parser.add_argument('--copy-connections', action='store', type=int,
+                        dest='copy_connections', default=None,
+                        help='number of connections this process loads the '
+                             'blocks serialized by the workers through, '
+                             'instead of each worker loading its own')
+
+    parser.add_argument('--nested-labels', action='store_true',
+                        dest='nested_labels', default=False,
+                        help='use every directory under ROOT_DIR containing '
+                             'images as a label, named by its relative path')
+
+    parser.add_argument('--scan-cache', action='store', dest='scan_cache',
+                        default=None,
+                        help='file in which to keep directory listings, so '
+                             'that later loads only list modified '
+                             'directories')
+
+    parser.add_argument('--training-table', action='store',
+                        dest='training_table', default=None,
+                        help='also pack the images into this table of '
+                             'mini-batch buffers, as training_preprocessor_dl '
+                             'would')
+
+    parser.add_argument('--buffer-size', action='store', type=int,
+                        dest='buffer_size', default=None,
+                        help='number of images per buffer of TRAINING_TABLE, '
+                             'or None for one buffer per block')
+
+    parser.add_argument('--normalizing-const', action='store', type=float,
+                        dest='normalizing_const', default=1.0,
+                        help='value the images in TRAINING_TABLE are divided '
+                             'by')
+
+    parser.add_argument('--class-values', action='store',
+                        dest='class_values', default=None,
+                        type=lambda s: s.split(','),
+                        help='comma separated labels one-hot encoded in '
+                             'TRAINING_TABLE, or None for the label '
+                             'directories')
+
+    parser.add_argument('--num-classes', action='store', type=int,
+                        dest='num_classes', default=None,
+                        help='length of the one-hot encoded labels in '
+                             'TRAINING_TABLE, if more than the number of '
+                             'class values')
+
+    parser.add_argument('--split', action='store', dest='split',
+                        default=None,
+                        type=lambda s: [(name, float(fraction)) for name,
+                                        fraction in (pair.split('=')
+                                        for pair in s.split(','))],
+                        help='comma separated name=fraction pairs, such as '
+                             'train=0.8,valid=0.1,test=0.1, to split the '
+                             'images between table_name_train, '
+                             'table_name_valid, ...')
+
+    parser.add_argument('--no-stratify', action='store_false',
+                        dest='stratify', default=True,
+                        help='split the images without regard to their '
+                             'labels')
+
+    parser.add_argument('--seed', action='store', type=int, dest='seed',
+                        default=0,
+                        help='seed of the random split and shuffle')
+
+    parser.add_argument('--shuffle', action='store_true', dest='shuffle',
+                        default=False,
+                        help='load the images in a random order')
+
+    parser.add_argument('--export', action='store', dest='export',
+                        default=None,
+                        help='instead of loading images, export table_name to '
+                             'EXPORT_x.npy and EXPORT_y.npy')
+
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        dest='incremental', default=False,
+                        help='only load images that are new or have changed '
+                             'since the last incremental load')
+
+    parser.add_argument('--resume', action='store_true', dest='resume',
+                        default=False,
+                        help='make the load resumable, or resume it if it '
+                             'was interrupted')
+
+    parser.add_argument('-m', '--no-temp-files', action='store_true',
+                        dest='no_temp_files', default=True,
+                        help="no temporary files, stream all image tables "
+                             "directly to the database")
+
+    parser.add_argument('--temp-files', action='store_false',
+                        dest='no_temp_files', default=argparse.SUPPRESS,
+                        help="write each block of images to a temporary file "
+                             "before loading it")
 
     parser.add_argument('table_name',
                         help='Name of table where images should be loaded')
 
     args = parser.parse_args()
 
+    # load_dataset_from_archive has no equivalent of these options
+    if args.archives:
+        unsupported = [option for option, value in
+                       (('--gpfdist', args.gpfdist),
+                        ('--copy-connections', args.copy_connections),
+                        ('-i/--incremental', args.incremental),
+                        ('--split', args.split),
+                        ('--shuffle', args.shuffle),
+                        ('--nested-labels', args.nested_labels),
+                        ('--scan-cache', args.scan_cache),
+                        ('-n/--num-labels', args.num_labels != 'all'))
+                       if value]
+        if unsupported:
+            parser.error("--archives can't be combined with {0}"
+                         .format(', '.join(unsupported)))
+
     db_creds = DbCredentials(args.db_name, args.username, args.password,
                              args.host, args.port)
 
-    iloader = ImageLoader(db_creds, int(args.num_workers))
+    preprocess = None
+    if args.resize or args.crop or args.mode or args.scale or \
+            args.mean is not None or args.std is not None:
+        preprocess = ImagePreprocessor(args.resize, args.crop, args.mode,
+                                       args.scale, args.mean, args.std)
+
+    training = None
+    if args.training_table:
+        training = TrainingPreprocessor(args.training_table, args.buffer_size,
+                                        args.normalizing_const,
+                                        args.class_values, args.num_classes)
+
+    split = None
+    if args.split or args.shuffle:
+        split = DataSplit(args.split, args.stratify, args.seed, args.shuffle)
+
+    ImageLoader.DECODER = args.decoder
+    ImageLoader.DISTRIBUTED_BY = args.distributed_by
+    ImageLoader.STORAGE = args.storage
+    ImageLoader.INDEXES = args.indexes
+    ImageLoader.ANALYZE = args.analyze
+
+    if args.rows_per_file == 'auto':
+        ImageLoader.ROWS_PER_FILE = None
+    else:
+        ImageLoader.ROWS_PER_FILE = int(args.rows_per_file)
+
+    if args.num_workers == 'auto':
+        iloader = ImageLoader(db_creds, 'auto')
+    else:
+        iloader = ImageLoader(db_creds, int(args.num_workers))
+
+    if args.export:
+        data_x, data_y = iloader.export_table_to_np(
+            args.table_name, args.export + '_x.npy')
+        if data_y is not None:
+            np.save(args.export + '_y.npy', data_y)
+        return
+
+    if args.archives:
+        iloader.load_dataset_from_archive(args.archives,
+                                          args.table_name,
+                                          args.append,
+                                          args.label_datatype,
+                                          args.binary,
+                                          args.no_temp_files,
+                                          resume=args.resume,
+                                          x_datatype=args.x_datatype,
+                                          preprocess=preprocess,
+                                          staging=args.staging,
+                                          training_preprocessor=training)
+        return
 
     iloader.load_dataset_from_disk(args.root_dir,
                                    args.table_name,
                                    args.num_labels,
                                    args.append,
-                                   args.label_datatype)
+                                   args.label_datatype,
+                                   args.binary,
+                                   args.no_temp_files,
+                                   resume=args.resume,
+                                   gpfdist=args.gpfdist,
+                                   x_datatype=args.x_datatype,
+                                   preprocess=preprocess,
+                                   staging=args.staging,
+                                   copy_connections=args.copy_connections,
+                                   incremental=args.incremental,
+                                   nested_labels=args.nested_labels,
+                                   scan_cache=args.scan_cache,
+                                   training_preprocessor=training,
+                                   split=split)
 
 if __name__ == '__main__':
     main()
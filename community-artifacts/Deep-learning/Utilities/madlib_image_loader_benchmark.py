@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+#
+# Benchmark for madlib_image_loader.py
+#
+# Generates synthetic image datasets and measures how fast ImageLoader loads
+#  them, for every combination of the options given on the command line:
+#
+#     --resolutions   image height and width, eg. 28,224
+#     --channels      1 (grayscale) and/or 3 (RGB)
+#     --dtypes        uint8 and/or float32 (float32 is only used with np)
+#     --skews         label skew.  Label i is drawn with probability
+#                       proportional to 1 / (i + 1)**skew, so 0 means
+#                       balanced labels, and larger values put more of the
+#                       images under the first few labels
+#     --sources       np (load_dataset_from_np), or jpeg / png
+#                       (load_dataset_from_disk, after writing the images to
+#                       a temporary directory)
+#     --workers       num_workers (auto to choose them during a warm-up)
+#     --rows-per-file ImageLoader.ROWS_PER_FILE (auto to size blocks by
+#                       ImageLoader.BYTES_PER_FILE)
+#     --formats       text and/or binary COPY
+#     --x-datatypes   REAL[], SMALLINT[] and/or BYTEA image column
+#                       (SMALLINT[] is only used with uint8)
+#     --copy-connections
+#                     copy_connections (0 for each worker to COPY its own
+#                       blocks)
+#     --gpfdist       0 and/or 1, to load through gpfdist (only used with
+#                       text COPY, and without copy_connections)
+#
+# By default, the data is sent to a mock COPY sink which reads and discards
+#  it, so the benchmark measures the client side of the loader only and
+#  doesn't need a database.  With --sink db, it is loaded into a real
+#  postgres or greenplum database instead (one scratch table per run, dropped
+#  afterwards), using the same connection options as madlib_image_loader.py.
+#  The mock sink only checks that the first row of each text COPY has an
+#  array literal in every array column, as postgres would, and doesn't parse
+#  the data any further, so run at least one configuration of a new option
+#  with --sink db before relying on its numbers.  With --gpfdist 1, the mock
+#  sink stands in for the Greenplum segments instead:  when the loader
+#  inserts from its external table, MOCK_SEGMENTS threads fetch the rows
+#  from the loader's gpfdist server (half of them with X-GP-PROTO: 1
+#  framing, which is checked), and every row they get is checked, and
+#  counted as inserted.
+#
+# Each run is done in a fresh process, so that peak memory use is measured
+#  per run.  One line of JSON is written per run (to stdout, or appended to
+#  the file given with -o), containing the configuration and:
+#
+#     images_per_s, mb_per_s  throughput, from ImageLoader.stats
+#     wall_s                  wall clock time of the load call
+#     cpu_user_s, cpu_sys_s   CPU time used by the loader process and its
+#                               workers during the load
+#     peak_rss_parent_kb      peak resident memory of the loader process
+#     peak_rss_worker_kb      peak resident memory of the largest worker
+#     workers_used            number of workers the load ended with
+#     rows_per_file_used      number of images per block
+#     stats                   ImageLoader.stats['total'] (per stage timings)
+#
+# Results of different releases can be compared by joining on the
+#  configuration fields.
+#
+# usage: madlib_image_loader_benchmark.py [-h] [--sink {mock,db}]
+#                                         [-N NUM_IMAGES] [-L NUM_LABELS]
+#                                         [--resolutions RESOLUTIONS]
+#                                         [--channels CHANNELS]
+#                                         [--dtypes DTYPES] [--skews SKEWS]
+#                                         [--sources SOURCES]
+#                                         [--workers WORKERS]
+#                                         [--rows-per-file ROWS_PER_FILE]
+#                                         [--formats FORMATS]
+#                                         [--x-datatypes X_DATATYPES]
+#                                         [--copy-connections COPY_CONNECTIONS]
+#                                         [--gpfdist GPFDIST]
+#                                         [--repeat REPEAT]
+#                                         [-o OUTPUT] [-d DB_NAME] [-p PORT]
+#                                         [-U USERNAME] [-t HOST]
+#                                         [-P PASSWORD]
+#
+
+import argparse
+import httplib
+import itertools
+import json
+from multiprocessing import Process, Queue
+import os
+import platform
+import re
+import resource
+from shutil import rmtree
+import struct
+import tempfile
+import threading
+import time
+import urlparse
+
+import numpy as np
+from PIL import Image
+
+import madlib_image_loader
+from madlib_image_loader import DbCredentials, ImageLoader
+
+# Number of segments the mock sink fetches the rows of a gpfdist load with
+MOCK_SEGMENTS = 4
+
+class MockCursor:
+    """
+    Stands in for a psycopg2 cursor.  COPY data is read in the same sized
+        pieces psycopg2 uses, and discarded, after checking the first row of
+        text COPYs against the column types of the table.  Inserts from a
+        gpfdist external table fetch its rows as Greenplum segments would.
+    """
+    statusmessage = 'MOCK'
+    rowcount = 0
+
+    # Column types of the tables created, by table name, and LOCATION of the
+    #  external tables.  Shared by all the cursors, as the workers are forked
+    #  after the tables are created.
+    tables = {}
+    locations = {}
+
+    def execute(self, query, args=None):
+        # Behave as if no manifest table exists, for resume=True
+        if query.startswith('SELECT unit FROM'):
+            raise madlib_image_loader.db.DatabaseError(query)
+        match = re.match(r'CREATE (?:READABLE EXTERNAL )?TABLE (\S+) '
+                         r'\(([^)]*)\)(?: LOCATION \(\'([^\']*)\'\))?', query)
+        if match:
+            MockCursor.tables[match.group(1)] = dict(
+                column.split(' ', 1) for column in match.group(2).split(', '))
+            if match.group(3):
+                MockCursor.locations[match.group(1)] = match.group(3)
+        match = re.match(r'INSERT INTO \S+ \(([^)]*)\) SELECT \* FROM (\S+)',
+                         query)
+        if match and match.group(2) in MockCursor.locations:
+            self.rowcount = self._fetch_gpfdist(match.group(2),
+                                                match.group(1).split(', '))
+
+    def _fetch_segment(self, location, proto):
+        """
+        Returns the data a segment gets from the gpfdist server at location
+        """
+        url = urlparse.urlparse(location.replace('gpfdist://', 'http://'))
+        conn = httplib.HTTPConnection(url.hostname, url.port)
+        conn.request('GET', url.path, headers={'X-GP-PROTO': str(proto)})
+        response = conn.getresponse()
+        if response.status != 200:
+            raise madlib_image_loader.db.DatabaseError(
+                'gpfdist returned {0} for {1}'.format(response.status,
+                                                      location))
+        data = response.read()
+        conn.close()
+        if proto == 0:
+            return data
+
+        # Check the framing of every block, and that the offsets add up
+        name = url.path.lstrip('/')
+        blocks, pos, offset = [], 0, 0
+        while pos < len(data):
+            headers = {}
+            for kind in 'FOLD':
+                if data[pos] != kind:
+                    raise madlib_image_loader.db.DatabaseError(
+                        'gpfdist sent {0!r} instead of a {1} header'
+                        .format(data[pos], kind))
+                length = struct.unpack_from('!i', data, pos + 1)[0]
+                pos += 5
+                headers[kind] = data[pos:pos + length] if kind != 'D' \
+                    else length
+                if kind != 'D':
+                    pos += length
+            if headers['F'] != name or \
+                    struct.unpack('!q', headers['O'])[0] < offset:
+                raise madlib_image_loader.db.DatabaseError(
+                    'gpfdist sent a bad block header {0!r}'.format(headers))
+            blocks.append(data[pos:pos + headers['D']])
+            offset = struct.unpack('!q', headers['O'])[0] + headers['D']
+            pos += headers['D']
+        return ''.join(blocks)
+
+    def _fetch_gpfdist(self, table, columns):
+        """
+        Fetches the rows of a gpfdist external table with MOCK_SEGMENTS
+            threads, checks every row and returns the number of rows
+        """
+        location = MockCursor.locations[table]
+        results = [None] * MOCK_SEGMENTS
+
+        def segment(i):
+            try:
+                results[i] = self._fetch_segment(location, i % 2)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=segment, args=(i,))
+                   for i in range(MOCK_SEGMENTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        num_rows = 0
+        for data in results:
+            if isinstance(data, Exception):
+                raise data
+            for line in data.splitlines():
+                if len(line.split('|')) != len(columns):
+                    raise madlib_image_loader.db.DatabaseError(
+                        'extra or missing data in row of {0}: "{1}"'
+                        .format(table, line[:40]))
+                self._check_row(table, columns, line, '|')
+                num_rows += 1
+        return num_rows
+
+    def fetchall(self):
+        return []
+
+    def _check_row(self, table, columns, line, sep):
+        types = MockCursor.tables.get(table)
+        if types is None:
+            return
+        for column, value in zip(columns, line.split(sep)):
+            if types[column].endswith('[]') and not value.startswith('{'):
+                raise madlib_image_loader.db.DatabaseError(
+                    'malformed array literal: "{0}" in column {1} of {2}'
+                    .format(value[:40], column, table))
+
+    def copy_from(self, f, table, sep='\t', null='\\N', size=8192,
+                  columns=None):
+        head = ''
+        data = f.read(size)
+        while data:
+            if head is not None:
+                head += data
+                if '\n' in head:
+                    self._check_row(table, columns, head.split('\n', 1)[0],
+                                    sep)
+                    head = None
+            data = f.read(size)
+
+    def copy_expert(self, sql, f, size=8192):
+        self.copy_from(f, None, size=size)
+
+    def close(self):
+        pass
+
+def _mock_db_connect(self):
+    self.db_cur = MockCursor()
+
+def make_dataset(num_images, num_labels, resolution, channels, dtype, skew,
+                 seed=0):
+    rng = np.random.RandomState(seed)
+    shape = (num_images, resolution, resolution)
+    if channels > 1:
+        shape += (channels,)
+    if dtype == 'uint8':
+        data_x = rng.randint(0, 256, shape).astype(np.uint8)
+    else:
+        data_x = rng.rand(*shape).astype(dtype)
+
+    p = 1.0 / (np.arange(num_labels) + 1) ** skew
+    data_y = rng.choice(num_labels, size=num_images, p=p / p.sum())
+    return data_x, data_y
+
+def write_dataset(data_x, data_y, root_dir, image_format):
+    ext = 'jpg' if image_format == 'jpeg' else image_format
+    for label in np.unique(data_y):
+        os.mkdir(os.path.join(root_dir, str(label)))
+    for i, (x, y) in enumerate(zip(data_x, data_y)):
+        Image.fromarray(x).save(os.path.join(root_dir, str(y),
+                                             '{0}.{1}'.format(i, ext)))
+
+def run(config, args, results):
+    """
+    Runs one load with the given configuration, in its own process, and puts
+        the measurements on results.
+    """
+    if args.sink == 'mock':
+        ImageLoader.db_connect = _mock_db_connect
+        ImageLoader.PROGRESS_INTERVAL = None
+        ImageLoader.GPFDIST_HOST = 'localhost'
+    if config['rows_per_file'] == 'auto':
+        ImageLoader.ROWS_PER_FILE = None
+    else:
+        ImageLoader.ROWS_PER_FILE = config['rows_per_file']
+
+    db_creds = DbCredentials(args.db_name, args.username, args.password,
+                             args.host, args.port)
+    iloader = ImageLoader(db_creds, config['workers'])
+    table_name = 'madlib_image_loader_benchmark_{0}'.format(os.getpid())
+    binary = config['format'] == 'binary'
+
+    data_x, data_y = make_dataset(args.num_images, args.num_labels,
+                                  config['resolution'], config['channels'],
+                                  config['dtype'], config['skew'])
+    root_dir = None
+    if config['source'] != 'np':
+        root_dir = tempfile.mkdtemp(prefix='madlib_benchmark_')
+        write_dataset(data_x, data_y, root_dir, config['source'])
+        del data_x, data_y
+
+    try:
+        usage_before = [resource.getrusage(who) for who in
+                        (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        start = time.time()
+        copy_connections = config['copy_connections'] or None
+        gpfdist = bool(config['gpfdist'])
+        if root_dir:
+            iloader.load_dataset_from_disk(root_dir, table_name,
+                                           binary=binary,
+                                           x_datatype=config['x_datatype'],
+                                           copy_connections=copy_connections,
+                                           gpfdist=gpfdist)
+        else:
+            iloader.load_dataset_from_np(data_x, data_y, table_name,
+                                         binary=binary,
+                                         x_datatype=config['x_datatype'],
+                                         copy_connections=copy_connections,
+                                         gpfdist=gpfdist)
+        wall = time.time() - start
+        usage_after = [resource.getrusage(who) for who in
+                       (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    finally:
+        if root_dir:
+            rmtree(root_dir)
+        if args.sink == 'db':
+            iloader.db_connect()
+            iloader.db_exec('DROP TABLE IF EXISTS {0}'.format(table_name))
+            iloader.db_close()
+
+    result = dict(config)
+    result.update({
+        'num_images': args.num_images,
+        'num_labels': args.num_labels,
+        'sink': args.sink,
+        'python': platform.python_version(),
+        'images_per_s': iloader.stats['total']['rows_per_s'],
+        'mb_per_s': iloader.stats['total']['mb_per_s'],
+        'wall_s': wall,
+        'workers_used': iloader.stats['num_workers'],
+        'rows_per_file_used': iloader.stats['rows_per_file'],
+        'cpu_user_s': sum(a.ru_utime - b.ru_utime
+                          for a, b in zip(usage_after, usage_before)),
+        'cpu_sys_s': sum(a.ru_stime - b.ru_stime
+                         for a, b in zip(usage_after, usage_before)),
+        'peak_rss_parent_kb': usage_after[0].ru_maxrss,
+        'peak_rss_worker_kb': usage_after[1].ru_maxrss,
+        'stats': iloader.stats['total'],
+    })
+    results.put(result)
+
+def configs(args):
+    axes = [('resolution', args.resolutions), ('channels', args.channels),
+            ('dtype', args.dtypes), ('skew', args.skews),
+            ('source', args.sources), ('workers', args.workers),
+            ('rows_per_file', args.rows_per_file), ('format', args.formats),
+            ('x_datatype', args.x_datatypes),
+            ('copy_connections', args.copy_connections),
+            ('gpfdist', args.gpfdist)]
+    for values in itertools.product(*[values for _, values in axes]):
+        config = dict(zip([name for name, _ in axes], values))
+        # Images on disk are always 8-bit
+        if config['source'] != 'np' and config['dtype'] != 'uint8':
+            continue
+        if config['x_datatype'] == 'SMALLINT[]' and config['dtype'] != 'uint8':
+            continue
+        if config['gpfdist'] and (config['format'] != 'text' or
+                                  config['copy_connections']):
+            continue
+        yield config
+
+def main():
+    def ints(s):
+        return [int(v) for v in s.split(',')]
+    def ints_or_auto(s):
+        return [v if v == 'auto' else int(v) for v in s.split(',')]
+    def floats(s):
+        return [float(v) for v in s.split(',')]
+    def strings(s):
+        return s.split(',')
+
+    parser = argparse.ArgumentParser(
+        description='Madlib Image Loader benchmark',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sink', choices=['mock', 'db'], default='mock',
+                        help='Discard COPY data (mock), or load it into db')
+    parser.add_argument('-N', '--num-images', type=int, default=5000,
+                        help='Number of images in each dataset')
+    parser.add_argument('-L', '--num-labels', type=int, default=10,
+                        help='Number of labels in each dataset')
+    parser.add_argument('--resolutions', type=ints, default=[32, 224],
+                        help='Comma separated image heights (and widths)')
+    parser.add_argument('--channels', type=ints, default=[3],
+                        help='Comma separated numbers of channels (1 or 3)')
+    parser.add_argument('--dtypes', type=strings, default=['uint8'],
+                        help='Comma separated numpy dtypes (uint8, float32)')
+    parser.add_argument('--skews', type=floats, default=[0.0],
+                        help='Comma separated label skews')
+    parser.add_argument('--sources', type=strings, default=['np', 'jpeg'],
+                        help='Comma separated sources (np, jpeg, png)')
+    parser.add_argument('--workers', type=ints_or_auto, default=[1, 5],
+                        help='Comma separated numbers of workers, or auto')
+    parser.add_argument('--rows-per-file', type=ints_or_auto, default=[1000],
+                        help='Comma separated values of ROWS_PER_FILE, or '
+                             'auto')
+    parser.add_argument('--formats', type=strings, default=['text', 'binary'],
+                        help='Comma separated COPY formats (text, binary)')
+    parser.add_argument('--x-datatypes', type=strings, default=['REAL[]'],
+                        help='Comma separated image column datatypes '
+                             '(REAL[], SMALLINT[], BYTEA)')
+    parser.add_argument('--copy-connections', type=ints, default=[0],
+                        help='Comma separated values of copy_connections (0 '
+                             'for workers to COPY their own blocks)')
+    parser.add_argument('--gpfdist', type=ints, default=[0],
+                        help='Comma separated 0 (COPY) and/or 1 (load '
+                             'through gpfdist)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of runs of each configuration')
+    parser.add_argument('-o', '--output', default=None,
+                        help='File to append results to (default: stdout)')
+    parser.add_argument('-d', '--db-name', dest='db_name', default='madlib',
+                        help='Name of database, for --sink db')
+    parser.add_argument('-p', '--port', default=5432,
+                        help='database server port, for --sink db')
+    parser.add_argument('-U', '--username', default=None,
+                        help='database user name, for --sink db')
+    parser.add_argument('-t', '--host', default='localhost',
+                        help='database server host, for --sink db')
+    parser.add_argument('-P', '--password', default=None,
+                        help='database user password, for --sink db')
+    args = parser.parse_args()
+
+    for config in configs(args):
+        for _ in range(args.repeat):
+            results = Queue()
+            p = Process(target=run, args=(config, args, results))
+            p.start()
+            p.join()
+            if p.exitcode != 0:
+                raise RuntimeError("Benchmark run failed: {0}".format(config))
+            line = json.dumps(results.get(), sort_keys=True)
+            if args.output:
+                with open(args.output, 'a') as f:
+                    f.write(line + '\n')
+            else:
+                print(line)
+
+if __name__ == '__main__':
+    main()